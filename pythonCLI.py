@@ -2,15 +2,28 @@
 
 import os
 import io
+import re
 import sys
 import stat
 import socket
-import filecmp
-import logging
+import threading
 import subprocess
 import tempfile
+import collections
+import copy
+import json
+import shutil
+import hashlib
+import atexit
+import mmap
+from multiprocessing.pool import ThreadPool
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 from xml.sax import handler, parseString, parse
 from common import *
+import common
 from cpk import get_cpk_issues
 import pygit2
 import codecs
@@ -51,10 +64,56 @@ def suggestIssues(ws_top, server, auth_opt=''):
 
     return msg
 
+# size of the buffer used to copy file contents into the fast-import stream
+BLOB_CHUNK_SIZE = 1024 * 1024
+
 def toGit(s):
 	print(s)
 	#logging.debug('[to git]: {}'.format(s))
 
+def copyToGit(f, size):
+    # copy exactly 'size' bytes of the open file 'f' to stdout
+    out_fd = sys.stdout.fileno()
+    sent = 0
+    if hasattr(os, 'sendfile') and stat.S_ISFIFO(os.fstat(out_fd).st_mode):
+        # let the kernel move the data when git is reading from a pipe
+        try:
+            while sent < size:
+                n = os.sendfile(out_fd, f.fileno(), sent, size - sent)
+                if n == 0:
+                    break
+                sent += n
+        except OSError as e:
+            # sendfile is not supported between these descriptors,
+            # copy the rest through the buffer instead
+            log_to_file('sendfile failed ({}), falling back to buffered copy'.format(e))
+        f.seek(sent)
+
+    while sent < size:
+        chunk = f.read(min(BLOB_CHUNK_SIZE, size - sent))
+        if not chunk:
+            break
+        sys.stdout.write(chunk)
+        sent += len(chunk)
+
+    if sent != size:
+        # the size has already been announced in the data command,
+        # the stream would be corrupted if we continued
+        display_accurev_error('file changed while sending it to git: {}\n'.format(f.name))
+        sys.exit(1)
+
+def toGitFile(path):
+    # data SP <count> LF <raw> LF?
+    # the file is streamed in chunks so that memory use does not
+    # depend on the size of the file
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        toGit('data {}'.format(size))
+        sys.stdout.flush()
+        copyToGit(f, size)
+        sys.stdout.flush()
+    toGit('')
+
 def toStdErr(msg):
     sys.stderr.write(msg)
     sys.stderr.flush()
@@ -81,6 +140,115 @@ def get_update_trans_from_commit_message(depot, msg):
             sys.exit(1)
     return ''
 
+class WorkerExit(Exception):
+    # carries a sys.exit() from a worker thread back to the main thread,
+    # thread pools only hand back exceptions derived from Exception
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+def exit_safe(func):
+    def wrapper(*args):
+        try:
+            return func(*args)
+        except SystemExit as e:
+            raise WorkerExit(e.code)
+    return wrapper
+
+def get_git_config_int(key, default, repo=None):
+    value = get_git_config(key, repo=repo)
+    try:
+        return int(value) if value else default
+    except ValueError:
+        log_to_file('ignoring invalid value for {}: {}'.format(key, value))
+        return default
+
+def get_git_config_size(key, default, repo=None):
+    # sizes in bytes, with an optional k/m/g suffix as in git
+    value = get_git_config(key, repo=repo).strip().lower()
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    try:
+        if value and value[-1] in units:
+            return int(value[:-1]) * units[value[-1]]
+        return int(value) if value else default
+    except ValueError:
+        log_to_file('ignoring invalid value for {}: {}'.format(key, value))
+        return default
+
+# most files in a population slice when the file sizes are not known
+SLICE_MAX_FILES = 10000
+
+def split_by_size(files, sizes, budget):
+    # split the files, in namespace order, into slices of at most
+    # 'budget' bytes so that a slice can be populated and drained
+    # before the next one starts
+    slices = []
+    slice = []
+    total = 0
+    for path, size in sorted(zip(files, sizes)):
+        if slice and (total + size > budget or len(slice) >= SLICE_MAX_FILES):
+            slices.append(slice)
+            slice = []
+            total = 0
+        slice.append(path)
+        total += size
+    if slice:
+        slices.append(slice)
+    return slices
+
+def split_namespace(files, nbatches):
+    # split the namespace into about 'nbatches' batches with a similar
+    # number of files, descending into the directories that are too large
+    counts = collections.defaultdict(int)
+    children = collections.defaultdict(set)
+    for path in files:
+        parent = path
+        while parent:
+            head = parent.rpartition('/')[0]
+            children[head].add(parent)
+            counts[parent] += 1
+            parent = head
+
+    limit = max(1, len(files) // max(1, nbatches))
+    items = []
+    dirs = ['']
+    while dirs:
+        for child in sorted(children[dirs.pop()]):
+            if counts[child] > limit and child in children:
+                dirs.append(child)
+            else:
+                items.append((child, counts[child]))
+
+    # largest first, the small ones are grouped together
+    batches = []
+    batch = []
+    size = 0
+    for path, n in sorted(items, key=lambda item: -item[1]):
+        if batch and size + n > limit:
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(path)
+        size += n
+    if batch:
+        batches.append(batch)
+    return batches
+
+def get_error_paths(err, prefix):
+    # the paths named by accurev error lines such as 'No element named /a/b'
+    # ('prefix /', additional length + 2, for space and backslash)
+    start_index = len(prefix) + 2
+    return set(line[start_index:].strip() for line in err.split('\n') if line.startswith(prefix))
+
+def split_path_pair(s):
+    # '<path> SP <path>' of a fast-export R or C, paths with spaces are quoted
+    if s.startswith('"'):
+        i = 1
+        while s[i] != '"':
+            i += 2 if s[i] == '\\' else 1
+        return s[:i + 1], s[i + 2:]
+    return tuple(s.split(' ', 1))
+
 def get_initial_update_trans(ref, depot):
     # get the initial commit
     out, _, _ = run_cmd('git rev-list --max-parents=0 --oneline {}'.format(ref))
@@ -88,9 +256,664 @@ def get_initial_update_trans(ref, depot):
     trans = get_update_trans_from_commit_message(depot, out)
     return trans
 
+def _to_text(s):
+    if isinstance(s, bytes):
+        return s.decode('utf-8', 'replace')
+    return s
+
+def _to_native(s):
+    # str on both python 2 and 3
+    if str is bytes and not isinstance(s, bytes):
+        return s.encode('utf-8')
+    return s
+
+class AcExecutor(object):
+    # every accurev command of the helper goes through here, which keeps
+    # the time spent waiting on the server per kind of command, answers a
+    # query asked again from memory until a command changes something,
+    # and can record the answers of a real server to replay them later
+    # offline, see README.md
+    #   GIT_ACCUREV_RECORD=<file>  appends each command and its output
+    #   GIT_ACCUREV_REPLAY=<file>  answers from such a file, no server needed
+
+    # commands that only read from the server; 'stat' is not one of them,
+    # its answer depends on the files the helper writes into the wspace
+    QUERIES = frozenset(['info', 'show', 'lsrules', 'hist'])
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {} # command -> [calls, seconds, longest call]
+        self._answers = {} # (kind, command) -> answer of a query, until the next change
+        self._changes = 0 # commands run that may have changed something
+        self._masks = [] # (value, label) that differ between record and replay
+        self._record = os.environ.get('GIT_ACCUREV_RECORD')
+        self._replay = None
+        path = os.environ.get('GIT_ACCUREV_REPLAY')
+        if path:
+            # answers to the same command are given in the recorded order
+            self._replay = collections.defaultdict(collections.deque)
+            with io.open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._replay[entry['cmd']].append(entry)
+            atexit.register(self.check_replayed)
+
+    def mask(self, value, label):
+        if value:
+            with self._lock:
+                self._masks.append((_to_text(value), label))
+                self._masks.sort(key=lambda m: -len(m[0]))
+
+    def key(self, cmd):
+        cmd = _to_text(cmd)
+        with self._lock:
+            masks = list(self._masks)
+        for value, label in masks:
+            cmd = cmd.replace(value, label)
+        # temp files (element lists, comments) get new names on every run
+        return re.sub(re.escape(_to_text(tempfile.gettempdir())) + r'[^\s"<]*', '<tmp>', cmd)
+
+    def account(self, name, seconds):
+        with self._lock:
+            stat = self._stats.setdefault(name, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+
+    def report(self):
+        with self._lock:
+            stats = sorted(self._stats.items(), key=lambda i: -i[1][1])
+        if not stats:
+            return
+        log_to_file('[accurev] {} calls in {:.2f}s'.format(sum(s[0] for _, s in stats), sum(s[1] for _, s in stats)))
+        for name, (calls, seconds, longest) in stats:
+            log_to_file('[accurev] {:<12} {:>6} calls {:>9.2f}s  (longest {:.2f}s)'.format(name, calls, seconds, longest))
+
+    def run(self, kind, func, cmd, *args, **kwargs):
+        # kind is how the result is handed back:
+        #   'out'   output only, accurev errors are fatal (run_ac)
+        #   'full'  (out, err, ret) (run_ac_ignore_error)
+        #   'async' output streamed to a callback (run_ac_async)
+        #   'xml'   cmd is an xml command file (run_ac_xml)
+        #   'xml-full' an xml command file, (out, err, ret)
+        if kind.startswith('xml'):
+            with open(cmd) as f:
+                text = f.read()
+            key = self.key('xml ' + ' '.join(text.split()))
+            match = re.search(r'command="(\w+)"', text)
+            name = 'xml ' + match.group(1) if match else 'xml'
+        else:
+            key = self.key(cmd)
+            name = cmd.split()[0] if cmd.strip() else ''
+        # a query naming a temp file (an element list) is not asked twice
+        memo = name in self.QUERIES and kind in ('out', 'full') and '<tmp>' not in key
+        if memo:
+            with self._lock:
+                answer = self._answers.get((kind, cmd))
+            if answer is not None:
+                self.account('(memo)', 0.0)
+                return answer
+        elif name not in self.QUERIES:
+            # the server may answer differently from now on
+            with self._lock:
+                self._answers.clear()
+                self._changes += 1
+        changes = self._changes
+        start = time.time()
+        try:
+            if self._replay is not None:
+                answer = self.replay(kind, key, *args)
+            elif self._record:
+                answer = self.record(kind, key, func, cmd, *args, **kwargs)
+            else:
+                answer = func(cmd, *args, **kwargs)
+        finally:
+            self.account(name, time.time() - start)
+            if name not in self.QUERIES:
+                # and for the queries that ran alongside it
+                with self._lock:
+                    self._answers.clear()
+                    self._changes += 1
+        if memo and (kind == 'out' or answer[2] == 0):
+            with self._lock:
+                # unless something changed while the query ran
+                if changes == self._changes:
+                    self._answers[(kind, cmd)] = answer
+        return answer
+
+    def record(self, kind, key, func, cmd, *args, **kwargs):
+        entry = {'cmd': key, 'out': '', 'err': '', 'ret': 0}
+        if kind == 'async':
+            callback = args[0]
+            def tee(f):
+                data = f.read()
+                entry['out'] = _to_text(data)
+                return callback(io.BytesIO(data))
+            result = func(cmd, tee, *args[1:], **kwargs)
+        else:
+            result = func(cmd, *args, **kwargs)
+            if kind in ('full', 'xml-full'):
+                out, err, ret = result
+                entry.update(out=_to_text(out), err=_to_text(err), ret=ret)
+            elif isinstance(result, (bytes, type(u''))):
+                entry['out'] = _to_text(result)
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            with io.open(self._record, 'a', encoding='utf-8') as f:
+                f.write(_to_text(line))
+        return result
+
+    def replay(self, kind, key, *args):
+        with self._lock:
+            answers = self._replay.get(key)
+            entry = answers.popleft() if answers else None
+        if entry is None:
+            display_accurev_error('no recorded answer for: {}\n'.format(_to_native(key)))
+            sys.exit(1)
+        out = _to_native(entry['out'])
+        if kind in ('full', 'xml-full'):
+            return out, _to_native(entry['err']), entry['ret']
+        if entry['ret'] != 0:
+            display_accurev_error(_to_native(entry['err']))
+            sys.exit(1)
+        if kind == 'async':
+            return args[0](io.BytesIO(out if isinstance(out, bytes) else out.encode('utf-8')))
+        return out
+
+    def check_replayed(self):
+        left = sum(len(answers) for answers in self._replay.values())
+        if left:
+            log_to_file('[accurev] {} recorded answers were not asked for'.format(left))
+
+ac_executor = AcExecutor()
+atexit.register(ac_executor.report)
+
+# the helpers from common, routed through the executor
+def run_ac(cmd, *args, **kwargs):
+    return ac_executor.run('out', common.run_ac, cmd, *args, **kwargs)
+
+def run_ac_ignore_error(cmd, *args, **kwargs):
+    return ac_executor.run('full', common.run_ac_ignore_error, cmd, *args, **kwargs)
+
+def run_ac_async(cmd, *args, **kwargs):
+    return ac_executor.run('async', common.run_ac_async, cmd, *args, **kwargs)
+
+def run_ac_xml(path, *args, **kwargs):
+    return ac_executor.run('xml', common.run_ac_xml, path, *args, **kwargs)
+
+def run_ac_xml_ignore_error(path):
+    # like run_ac_xml, but returns (out, err, ret) instead of failing
+    return ac_executor.run('xml-full', lambda p: run_cmd('accurev xml -l "{}"'.format(p)), path)
+
+class ElementJournal(object):
+    # the fast-import element lines of an import in their natural order,
+    # kept in a single byte buffer instead of one string per line, and
+    # spilled to a temp file whenever the buffer grows past 'limit' bytes
+    def __init__(self, limit=64 * 1024 * 1024):
+        self._limit = limit
+        self._buffer = bytearray()
+        self._spill = None
+        self._count = 0
+        # file that also gets every appended line
+        self._tee = None
+
+    def set_tee(self, f):
+        self._tee = f
+
+    def append(self, elem):
+        self._buffer.extend(elem)
+        self._buffer.extend('\n')
+        self._count += 1
+        if self._tee is not None:
+            self._tee.write('{}\n'.format(elem))
+        if len(self._buffer) > self._limit:
+            if self._spill is None:
+                self._spill = tempfile.TemporaryFile()
+                log_to_file('element list is larger than {} bytes, spilling to disk'.format(self._limit))
+            self._spill.write(self._buffer)
+            del self._buffer[:]
+
+    def __len__(self):
+        return self._count
+
+    def __nonzero__(self):
+        return self._count > 0
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        if self._spill is not None:
+            self._spill.flush()
+            self._spill.seek(0)
+            for line in self._spill:
+                yield line[:-1]
+            self._spill.seek(0, os.SEEK_END)
+        for line in str(self._buffer).split('\n')[:-1]:
+            yield line
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        del self._buffer[:]
+        self._count = 0
+
+
+class CloneJournal(object):
+    # progress of a clone, kept next to the git marks so that a fetch
+    # after an interrupted clone can carry on from its last drained batch
+    #   batches - '<id> <path>' for every path of every population batch
+    #   done    - ids of the batches that are in git, one per line
+    #   elems   - element lines of the commit sent to git so far
+    def __init__(self, path):
+        self._path = path
+        self._elems = None
+
+    def file(self, name):
+        return os.path.join(self._path, name)
+
+    def exists(self):
+        return os.path.isdir(self._path)
+
+    def start(self):
+        make_sure_path_exists(self._path)
+
+    def remove(self):
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def set_batches(self, batches):
+        temp = self.file('batches.tmp')
+        with open(temp, 'wb') as f:
+            for batch_id, batch in batches:
+                for path in batch:
+                    f.write('{} {}\n'.format(batch_id, path))
+        if os.path.exists(self.file('batches')):
+            os.remove(self.file('batches'))
+        os.rename(temp, self.file('batches'))
+
+    def get_batches(self):
+        batches = collections.OrderedDict()
+        if os.path.exists(self.file('batches')):
+            with open(self.file('batches'), 'rb') as f:
+                for line in f:
+                    batch_id, path = line.rstrip('\n').split(' ', 1)
+                    batches.setdefault(int(batch_id), []).append(path)
+        return list(batches.items())
+
+    def get_done(self):
+        done = set()
+        if os.path.exists(self.file('done')):
+            with open(self.file('done'), 'rb') as f:
+                done.update(int(l) for l in f if l.strip())
+        return done
+
+    def get_elems(self):
+        if not os.path.exists(self.file('elems')):
+            return []
+        with open(self.file('elems'), 'rb') as f:
+            return [l.rstrip('\n') for l in f if l.strip()]
+
+    def open_elems(self):
+        self._elems = open(self.file('elems'), 'ab')
+        return self._elems
+
+    def set_done(self, batch_id):
+        # the element lines must be on disk before the batch counts as done
+        self._elems.flush()
+        os.fsync(self._elems.fileno())
+        with open(self.file('done'), 'ab') as f:
+            f.write('{}\n'.format(batch_id))
+
+    def close(self):
+        if self._elems:
+            self._elems.close()
+            self._elems = None
+
+
+class CommitTransIndex(object):
+    # the depot:trans of the commits we imported, so that the basis of a
+    # push is found without reading commit messages or running git
+    #   '<sha> <depot>:<trans>'   an imported commit
+    #   '<sha> -'                 a pushed commit, its basis is its keep
+    #   'root <depot>:<trans>'    the first import of the tracking ref
+    #   ':<mark> <depot>:<trans>' an import git has not given a sha yet
+    # fast-import marks start over on every fetch, so the marks of the last
+    # import must be resolved before the next import reuses them
+    def __init__(self, path):
+        self._path = path
+        self._entries = None
+        self._pending = None
+        self._lock = threading.Lock() # the ancestors of a merge are looked up side by side
+
+    def load(self):
+        # with the lock held
+        if self._entries is None:
+            self._entries = {}
+            self._pending = collections.OrderedDict()
+            if os.path.exists(self._path):
+                with open(self._path, 'rb') as f:
+                    for line in f:
+                        key, _, value = line.strip().partition(' ')
+                        if key.startswith(':'):
+                            self._pending[key] = value
+                        elif key:
+                            self._entries[key] = value
+
+    def has_pending(self):
+        with self._lock:
+            self.load()
+            return bool(self._pending)
+
+    def get_trans(self, depot, key):
+        # None if 'key' is not in the index, '' if it is not an import from depot
+        with self._lock:
+            self.load()
+            value = self._entries.get(key)
+        if value is None:
+            return None
+        d, _, trans = value.rpartition(':')
+        return trans if d == depot else ''
+
+    def add(self, pairs):
+        with self._lock:
+            self.load()
+            for key, value in pairs:
+                if key.startswith(':'):
+                    self._pending[key] = value
+                else:
+                    self._entries[key] = value
+            make_sure_path_exists(os.path.dirname(self._path))
+            with open(self._path, 'ab') as f:
+                for key, value in pairs:
+                    f.write('{} {}\n'.format(key, value))
+
+    def resolve(self, marks, repo):
+        # file the pending imports under the sha git wrote for their mark,
+        # unless the mark is not that import (the fetch did not finish)
+        with self._lock:
+            self.load()
+            if not self._pending:
+                return
+            for mark, value in self._pending.items():
+                sha = marks.get(mark)
+                commit = repo.get(sha, None) if sha else None
+                depot, _, trans = value.rpartition(':')
+                if commit and get_update_trans_from_commit_message(depot, commit.message) == trans:
+                    self._entries[sha] = value
+            self._pending.clear()
+
+            temp = '{}.tmp'.format(self._path)
+            with open(temp, 'wb') as f:
+                for key, value in self._entries.items():
+                    f.write('{} {}\n'.format(key, value))
+            if os.path.exists(self._path):
+                os.remove(self._path)
+            os.rename(temp, self._path)
+
+
+class MarksStore(object):
+    # the git marks files, searched on demand instead of read into a dict:
+    # git rewrites them at the end of every fetch and push, so nothing built
+    # from them outlives a run, and a run only asks for a few marks. The
+    # marks fast-import writes are sorted by number and found by a binary
+    # search of the file, those of fast-export are in no order and need a
+    # scan; a batch of many marks is one pass over the file. The answers
+    # are remembered
+    def __init__(self):
+        self._paths = [] # a later file overrides an earlier one
+        self._found = {} # mark -> sha, None if in no file
+
+    def __repr__(self):
+        return '<MarksStore {} file(s), {} mark(s) looked up>'.format(len(self._paths), len(self._found))
+
+    def load(self, path):
+        self._paths.append(path)
+        self._found.clear()
+
+    def set_new(self, mark):
+        # defined by the stream being read, git has not written it yet
+        self._found.setdefault(mark, None)
+
+    def bisect(self, data, number):
+        # the offset of the line of mark 'number' if the file is sorted by
+        # mark, -1 if it is not found that way
+        lo, hi = 0, len(data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind('\n', 0, mid) + 1
+            end = data.find(' ', start)
+            if end < 0 or data[start:start + 1] != ':' or not data[start + 1:end].isdigit():
+                return -1
+            found = int(data[start + 1:end])
+            if found == number:
+                return start
+            if found < number:
+                next_line = data.find('\n', start)
+                if next_line < 0:
+                    return -1
+                lo = next_line + 1
+            else:
+                hi = start
+        return -1
+
+    def search(self, path, mark):
+        # the file is only mapped for the search, git replaces it later on
+        needle = '{} '.format(mark)
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return None
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = self.bisect(data, int(mark[1:])) if mark[1:].isdigit() else -1
+            if start < 0 and data[:len(needle)] == needle:
+                start = 0
+            elif start < 0:
+                # not sorted, or not there
+                start = data.find('\n' + needle)
+                if start < 0:
+                    return None
+                start += 1
+            end = data.find('\n', start)
+            return data[start + len(needle):end if end >= 0 else len(data)].strip()
+        finally:
+            data.close()
+
+    def prefetch(self, marks):
+        # looks up many marks in a single pass over each file
+        wanted = set(m for m in marks if m not in self._found)
+        if not wanted:
+            return
+        found = {}
+        for path in self._paths:
+            with open(path, 'rb') as f:
+                for line in f:
+                    mark, _, sha = line.partition(' ')
+                    if mark in wanted:
+                        found[mark] = sha.strip()
+        for mark in wanted:
+            self._found[mark] = found.get(mark)
+
+    def get(self, mark, default=None):
+        if not mark or not mark.startswith(':'):
+            return default
+        if mark not in self._found:
+            sha = None
+            for path in reversed(self._paths):
+                sha = self.search(path, mark)
+                if sha:
+                    break
+            self._found[mark] = sha
+        sha = self._found[mark]
+        return default if sha is None else sha
+
+    def __contains__(self, mark):
+        return self.get(mark) is not None
+
+    def __getitem__(self, mark):
+        sha = self.get(mark)
+        if sha is None:
+            raise KeyError(mark)
+        return sha
+
+
+class PushPlan(object):
+    # the paths of a commit (or squash) being pushed, each with what is to
+    # be done to it: 'defunct', 'add', 'keep' or 'move'. Paths stay in the
+    # order they were first planned, changing or dropping one is O(1)
+    def __init__(self):
+        self._paths = collections.OrderedDict()
+        self._counts = collections.defaultdict(int)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    def get(self, path):
+        return self._paths.get(path)
+
+    def set(self, path, state):
+        old_state = self._paths.get(path)
+        if old_state is not None:
+            self._counts[old_state] -= 1
+        self._paths[path] = state
+        self._counts[state] += 1
+
+    def discard(self, path):
+        state = self._paths.pop(path, None)
+        if state is not None:
+            self._counts[state] -= 1
+
+    def count(self, state):
+        return self._counts[state]
+
+    def paths(self, state):
+        return [path for path, s in self._paths.items() if s == state]
+
+
+class ElemVersCache(object):
+    # element versions at a fixed basis (a transaction, or the keep of a
+    # pushed commit) never change, so each (basis, element) pair is only
+    # asked for once per push; the least recently used of more than
+    # 'size' entries are dropped
+    def __init__(self, size):
+        self._size = size
+        self._entries = collections.OrderedDict() # (basis, path) -> (eid, version) or None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def __repr__(self):
+        return '{} hits, {} misses, {} entries'.format(self._hits, self._misses, len(self._entries))
+
+    def get(self, basis, path):
+        # returns (found, (eid, version) or None)
+        key = (basis, path)
+        with self._lock:
+            if key not in self._entries:
+                self._misses += 1
+                return False, None
+            self._hits += 1
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return True, value
+
+    def put(self, basis, path, value):
+        with self._lock:
+            self._entries.pop((basis, path), None)
+            self._entries[(basis, path)] = value
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+
+class BlobSpool(object):
+    # the blobs of a push as fast-export sends them, until the commit that
+    # uses them has been written to the wspace; up to 'limit' bytes are
+    # kept in memory, the rest goes to a temp file. A released blob is only
+    # remembered by its git id and read back from the repo if a later
+    # commit refers to its mark again
+    def __init__(self, repo, limit=64 * 1024 * 1024):
+        self._repo = repo
+        self._limit = limit
+        self._memory = {} # mark -> data
+        self._memory_size = 0
+        self._spool = None
+        self._spooled = {} # mark -> (offset, size) in the spool file
+        self._shas = {} # mark -> git blob id
+
+    def __repr__(self):
+        return '{} in memory ({} bytes), {} spooled, {} released'.format(
+            len(self._memory), self._memory_size, len(self._spooled),
+            len(self._shas) - len(self._memory) - len(self._spooled))
+
+    def read(self, mark, size, f):
+        # reads 'size' bytes of blob data from 'f'
+        sha = hashlib.sha1('blob {}\0'.format(size).encode('ascii'))
+        if self._memory_size + size <= self._limit:
+            data = f.read(size)
+            sha.update(data)
+            self._memory[mark] = data
+            self._memory_size += len(data)
+        else:
+            if self._spool is None:
+                self._spool = tempfile.TemporaryFile()
+                log_to_file('blobs of the push are larger than {} bytes, spooling to disk'.format(self._limit))
+            self._spool.seek(0, os.SEEK_END)
+            offset = self._spool.tell()
+            left = size
+            while left > 0:
+                chunk = f.read(min(BLOB_CHUNK_SIZE, left))
+                if not chunk:
+                    break
+                sha.update(chunk)
+                self._spool.write(chunk)
+                left -= len(chunk)
+            self._spooled[mark] = (offset, size - left)
+        self._shas[mark] = sha.hexdigest()
+
+    def sha(self, mark):
+        return self._shas.get(mark)
+
+    def write_to(self, mark, f, sha):
+        # writes the blob of 'mark', whose git id is 'sha', into the open file 'f'
+        if mark in self._memory:
+            f.write(self._memory[mark])
+        elif mark in self._spooled:
+            offset, size = self._spooled[mark]
+            self._spool.seek(offset)
+            while size > 0:
+                chunk = self._spool.read(min(BLOB_CHUNK_SIZE, size))
+                if not chunk:
+                    break
+                f.write(chunk)
+                size -= len(chunk)
+        else:
+            # released, or not in this stream at all
+            f.write(self._repo[sha].data)
+
+    def release(self, mark):
+        data = self._memory.pop(mark, None)
+        if data is not None:
+            self._memory_size -= len(data)
+        if self._spooled.pop(mark, None) and not self._spooled:
+            # nothing left in the spool file, start it over
+            self._spool.seek(0)
+            self._spool.truncate()
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self._memory.clear()
+        self._spooled.clear()
+        self._memory_size = 0
+
+
 class UpdateParser(handler.ContentHandler):
 
-    def __init__(self, ws_top, reroot, server, auth_opt='', show_progress=False):
+    def __init__(self, ws_top, reroot, server, auth_opt='', show_progress=False, repo=None, odb_threads=1,
+                 dedupe_repo=None, parent_tree=None, queue_size=0, journal_limit=64 * 1024 * 1024):
         self._server = server
         self._auth_opt = auth_opt  # to impersonate a user
         self._tag = ''
@@ -98,13 +921,42 @@ class UpdateParser(handler.ContentHandler):
         self._action = ''
         self._element = ''
         self._has_incoming_changes = False
-        self._elem_list = []
+        self._elem_list = ElementJournal(journal_limit)
 
         self._mark = 1
         self._ws_top = ws_top
         self._root = ''
         self._reroot = reroot
 
+        # when a repo is given, blobs are written straight into its object
+        # database by a pool of worker threads and referenced by SHA
+        self._repo = repo
+        self._odb_threads = max(1, odb_threads)
+        self._odb_pool = None
+        self._odb_local = threading.local()
+        # element lines (or blobs still being written) in their natural order
+        self._pending = collections.deque()
+
+        # batch parsers populating concurrently hand their elements to
+        # the owner, one at a time
+        self._owner = None
+        self._lock = threading.RLock()
+
+        # with a queue size, the XML is parsed on its own thread and the
+        # elements are sent to git from the calling thread, so that the
+        # accurev output keeps flowing while large files are copied
+        self._queue_size = queue_size
+        self._queue = None
+        # called with the id of each drained batch
+        self._on_drained = None
+
+        # when a dedupe repo is given, files git already has are referenced
+        # by SHA and files unchanged from the parent tree are left out
+        self._dedupe_repo = dedupe_repo
+        self._parent_tree = parent_tree.id if parent_tree is not None else None
+        self._deleted = set()
+        self._deduped = 0
+
         # for progress
         self._number = 0
         self._checkpoint = 0
@@ -130,7 +982,133 @@ class UpdateParser(handler.ContentHandler):
         return repStr
 
     def execute(self, cmdline):
-        run_ac_async(cmdline, lambda f: parse(f, self), self._server, self._auth_opt)
+        self.run_pipelined(lambda: run_ac_async(cmdline, lambda f: parse(f, self), self._server, self._auth_opt))
+        self.flush_pending()
+
+    def run_pipelined(self, producer):
+        if not self._queue_size:
+            producer()
+            return
+
+        self._queue = queue.Queue(self._queue_size)
+        errors = []
+        def produce():
+            try:
+                producer()
+            except BaseException as e:
+                # includes the sys.exit() of a failed accurev command
+                errors.append(e)
+            finally:
+                self._queue.put(None)
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                elem = self._queue.get()
+                if elem is None:
+                    break
+                if elem[0] == 'drain':
+                    self.flush_pending()
+                    self.drained(elem[2])
+                    elem[1].set()
+                    continue
+                self.update_one_element(*elem)
+        finally:
+            self._queue = None
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        if self._odb_pool:
+            self._odb_pool.close()
+            self._odb_pool.join()
+            self._odb_pool = None
+
+    def add_elem(self, elem):
+        # keep the order of the elements even when some of the blobs
+        # are still being written by the worker threads
+        if self._pending:
+            self._pending.append(elem)
+        else:
+            self._elem_list.append(elem)
+
+    def flush_pending(self, limit=0):
+        # move finished elements to the element list, waiting on the
+        # oldest blob until no more than 'limit' elements are pending
+        while self._pending:
+            elem = self._pending[0]
+            if not isinstance(elem, tuple):
+                self._elem_list.append(self._pending.popleft())
+                continue
+            result, file = elem
+            if len(self._pending) <= limit and not result.ready():
+                break
+            self._pending.popleft()
+            sha = result.get()
+            if sha:
+                self._elem_list.append('M 100644 {} {}'.format(sha, file))
+
+    def get_odb(self):
+        # pygit2 repositories should not be shared between threads
+        repo = getattr(self._odb_local, 'repo', None)
+        if repo is None:
+            repo = pygit2.Repository(self._repo.path)
+            self._odb_local.repo = repo
+        return repo
+
+    def write_blob(self, path, file):
+        repo = self.get_odb()
+        oid = pygit2.hashfile(path)
+        if self.in_parent_tree(repo, file, oid):
+            sha = ''
+        else:
+            if oid not in repo:
+                oid = repo.create_blob_fromdisk(path)
+            sha = str(oid)
+        self.remove_file(path)
+        return sha
+
+    def in_parent_tree(self, repo, file, oid):
+        # True when the parent commit already has this content at this path
+        if self._parent_tree is None:
+            return False
+        # a path deleted earlier in this update has to be added back
+        parent = file
+        while parent:
+            if parent in self._deleted:
+                return False
+            parent = parent.rpartition('/')[0]
+        try:
+            entry = repo[self._parent_tree][file]
+        except KeyError:
+            return False
+        return entry.id == oid and entry.filemode == pygit2.GIT_FILEMODE_BLOB
+
+    def dedupe_file(self, path, file):
+        # returns True when no blob needs to be sent for this file
+        repo = self._dedupe_repo
+        oid = pygit2.hashfile(path)
+        if self.in_parent_tree(repo, file, oid):
+            pass
+        elif oid in repo:
+            self.add_elem('M 100644 {} {}'.format(oid, file))
+        else:
+            return False
+        self._deduped += 1
+        self.remove_file(path)
+        return True
+
+    def remove_file(self, path):
+        try:
+            os.chmod(path, stat.S_IWRITE)
+            os.remove(path)
+        except:
+            # failure to remove is not a critical error
+            # should just log it and move on
+            log_to_file('Failed to remove file: {}'.format(path.encode('utf-8')))
 
     def do_update_preview(self):
         self.execute('update -fx -i -L {}'.format(self._ws_top))
@@ -151,6 +1129,80 @@ class UpdateParser(handler.ContentHandler):
         self._root = root
         self.execute('pop -fx {}-L {} -O -R /./'.format(self._progress, self._ws_top))
 
+    def do_parallel_pop(self, root, batches, jobs, drain=False):
+        # populate the (id, paths) batches concurrently, each through its
+        # own accurev process, and merge their elements into this parser
+        # with 'drain', a batch is sent to git and removed from the
+        # workspace before its worker moves on to the next one, and
+        # _on_drained is called with its id
+        self._root = root
+        self.run_pipelined(lambda: self.pop_batches(batches, jobs, drain))
+        self.flush_pending()
+
+    def pop_batches(self, batches, jobs, drain):
+        pool = ThreadPool(jobs)
+        done = 0
+        pop = exit_safe(lambda batch: self.pop_batch(batch[1], drain, batch[0]))
+        try:
+            for _ in pool.imap_unordered(pop, batches):
+                done += 1
+                if self._progress:
+                    pct = (float(done) / len(batches)) * 100
+                    toStdErr("\rReceiving objects: {}% ({}/{} batches)".format(int(pct), done, len(batches)))
+        except WorkerExit as e:
+            pool.terminate()
+            sys.exit(e.code)
+        pool.close()
+        pool.join()
+        if self._progress and done:
+            toStdErr(", done.\n")
+
+    def pop_batch(self, batch, drain=False, batch_id=None):
+        temp = tempfile.NamedTemporaryFile(delete=False)
+        temp.write(codecs.BOM_UTF8)  # changes the file to UTF-8-BOM
+        for path in batch:
+            temp.write('/./{}\n'.format(path))
+        temp.close()
+
+        parser = copy.copy(self)
+        parser._owner = self
+        parser._tag = ''
+        parser._message = ''
+        parser._action = ''
+        parser._element = ''
+        run_ac_async('pop -fx -L {} -O -R -l {}'.format(self._ws_top, temp.name), lambda f: parse(f, parser),
+                     self._server, self._auth_opt)
+        os.remove(temp.name)
+        if drain:
+            self.wait_drained(batch_id)
+
+    def wait_drained(self, batch_id=None):
+        # returns once every element handed over so far has been sent
+        # to git and its file removed from the workspace
+        if self._queue is not None:
+            event = threading.Event()
+            self._queue.put(('drain', event, batch_id))
+            event.wait()
+        else:
+            with self._lock:
+                self.flush_pending()
+                self.drained(batch_id)
+
+    def drained(self, batch_id):
+        if self._on_drained:
+            self._on_drained(self, batch_id)
+
+    def emit(self, op, file, file2):
+        owner = self._owner or self
+        if owner._queue is not None:
+            # blocks while the emitter is behind
+            owner._queue.put((op, file, file2))
+        elif owner is self:
+            self.update_one_element(op, file, file2)
+        else:
+            with owner._lock:
+                owner.update_one_element(op, file, file2)
+
     def startElement(self, name, attr):
         #logging.debug('startElement(name: {}, attr: {}'.format(name, attr))
         self._tag = name
@@ -197,7 +1249,7 @@ class UpdateParser(handler.ContentHandler):
                 src_name = msg[1].encode('utf-8')
                 dst_name = msg[3].encode('utf-8')
                 #self._element_list.append(('move', src_name, dst_name))
-                self.update_one_element('move', src_name, dst_name)
+                self.emit('move', src_name, dst_name)
             elif 'Would ' in self._message:
                 #self._action = 'preview'
                 self._action = ''
@@ -207,7 +1259,7 @@ class UpdateParser(handler.ContentHandler):
             self._message = ''
         elif name == 'element' and self._action != '':
             #self._element_list.append((self._action, self._element, ''))
-            self.update_one_element(self._action, self._element, '')
+            self.emit(self._action, self._element, '')
             self._action = ''
             self._element = ''
         elif name == 'acResponse' or name == 'AcResponse':
@@ -246,40 +1298,55 @@ class UpdateParser(handler.ContentHandler):
                         for l in f:
                             #logging.debug('.acsubmoduleIDs: {}'.format(l))
                             submod, shaID = l.split()
-                            self._elem_list.append('M 160000 {} {}'.format(shaID, submod))
+                            self.add_elem('M 160000 {} {}'.format(shaID, submod))
+                    return
+
+                if self._repo is not None:
+                    if not self._odb_pool:
+                        self._odb_pool = ThreadPool(self._odb_threads)
+                    result = self._odb_pool.apply_async(self.write_blob, (path, file))
+                    self._pending.append((result, file))
+                    # bound the number of files waiting on disk
+                    self.flush_pending(limit=self._odb_threads * 4)
+                    return
+
+                if self._dedupe_repo is not None and self.dedupe_file(path, file):
                     return
+
                 toGit('blob')
                 toGit('mark :{}'.format(self._mark))
-                toGit('data {}'.format(os.path.getsize(path)))
-                with open(path, 'rb') as f:
-                    print(f.read())
-                    # this prints the file contents to the log
-                    # which can be excessive
-                    #toGit(f.read())
+                toGitFile(path)
 
                 # M SP <mode> SP <dataref> SP <path> LF
-                self._elem_list.append('M 100644 :{} {}'.format(self._mark, file))
+                self.add_elem('M 100644 :{} {}'.format(self._mark, file))
                 self._mark += 1
-
-                try:
-                    os.chmod(path, stat.S_IWRITE)
-                    os.remove(path)
-                except:
-                    # failure to remove is not a critical error
-                    # should just log it and move on
-                    log_to_file('Failed to remove file: {}'.format(path.encode('utf-8')))
+                self.remove_file(path)
 
         elif op == 'delete':
-            self._elem_list.append('D {}'.format(file))
+            self._deleted.add(file)
+            self.add_elem('D {}'.format(file))
         elif op == 'move':
-            self._elem_list.append('R "{}" "{}"'.format(file, file2))
+            # paths after a move no longer line up with the parent tree
+            self._parent_tree = None
+            self.add_elem('R "{}" "{}"'.format(file, file2))
 
 class UpdateTransParser(handler.ContentHandler):
-    def __init__(self, server, auth_opt=''):
+    def __init__(self, server, auth_opt='', ws_name=''):
         self._update_trans = {}
         # for a proxy end user, on passing the auth token it fetches only that user's wspaces instead of
         # all wspaces. So, we use '-a' option to get all wspaces.
-        run_ac_async('show -fix{} wspaces'.format(' -a' if auth_opt else ''), lambda f: parse(f, self), server, auth_opt)
+        all_opt = ' -a' if auth_opt else ''
+        if ws_name:
+            # ask for this one wspace only, so that the cost does not grow with
+            # the number of wspaces on the server
+            out, err, ret = run_ac_ignore_error('show -fix{} -s "{}" wspaces'.format(all_opt, ws_name), server, auth_opt)
+            if ret == 0 and out:
+                parseString(out.encode('utf-8'), self)
+                if ws_name in self._update_trans:
+                    return
+            # older servers do not take a stream for 'show wspaces'
+            log_to_file('no update trans for {} from "show -s" ({}), listing all wspaces'.format(ws_name, err.strip()))
+        run_ac_async('show -fix{} wspaces'.format(all_opt), lambda f: parse(f, self), server, auth_opt)
 
     def startElement(self, name, attr):
         if name == 'Element':
@@ -353,6 +1420,35 @@ class TransHistParser(handler.ContentHandler):
             self.isComment = False
 
 
+# transactions that can change what a stream shows, the other kinds only
+# change workspaces or metadata
+CONTENT_TRANS_KINDS = frozenset(['promote', 'purge', 'chstream', 'defcomp', 'incl', 'excl', 'incldo', 'clear',
+                                 'demote_to', 'demote_from', 'revert'])
+
+class DepotHistParser(handler.ContentHandler):
+    # lists the transactions of a depot in a range such as 'now' or '1200-1100'
+    # as (id, type, stream, user)
+    def __init__(self, depot, trans_range, server, auth_opt=''):
+        self._transactions = []
+        run_ac_async('hist -p "{}" -t {} -fx'.format(depot, trans_range), lambda f: parse(f, self), server, auth_opt)
+
+    def get_head_trans(self):
+        if not self._transactions:
+            return ''
+        return str(max(int(t[0]) for t in self._transactions))
+
+    def startElement(self, name, attr):
+        if name == 'transaction':
+            self._transactions.append((attr.getValue('id'), attr.get('type', ''),
+                                       attr.get('streamName', ''), attr.get('user', '')))
+
+    def characters(self, ch):
+        pass
+
+    def endElement(self, name):
+        pass
+
+
 class StatusParser(handler.ContentHandler):
     def __init__(self, list_path, ws_top, server, auth_opt=''):
         self._list_path = list_path
@@ -386,8 +1482,91 @@ class StatusParser(handler.ContentHandler):
         pass
 
 
+class ElemListParser(handler.ContentHandler):
+    # lists the files of a workspace, whether they are populated or not
+    def __init__(self, ws_top, server, auth_opt=''):
+        self._files = []
+        self._sizes = []
+        run_ac_async('stat -a -fx -L {}'.format(ws_top), lambda f: parse(f, self), server, auth_opt)
+
+    def startElement(self, name, attr):
+        if name == 'element':
+            if attr.get('dir') == 'yes' or attr.get('elemType') == 'dir':
+                return
+            location = attr.getValue('location').replace('\\', '/')
+            if location.startswith('/./'):
+                location = location[3:]
+            if location and location != '/.':
+                self._files.append(location.encode('utf-8'))
+                # not every server version reports the size
+                size = attr.get('size', '')
+                self._sizes.append(int(size) if size.isdigit() else 0)
+
+    def characters(self, ch):
+        pass
+
+    def endElement(self, name):
+        pass
+
+
+class WspaceCatalog(object):
+    # the wspaces and principal of a server as last listed by 'show wspaces',
+    # kept on disk so that clones within 'ttl' seconds of each other do not
+    # download the whole listing again
+    ATTRS = ('Name', 'user_name', 'Host', 'Storage', 'depot', 'hidden')
+
+    def __init__(self, server, auth_opt, ttl):
+        # the listing depends on who is asking
+        key = hashlib.sha1('{} {}'.format(server, auth_opt.strip()).encode('utf-8')).hexdigest()
+        self._path = os.path.join(os.path.expanduser('~'), '.accurev', 'git', 'wspaces-{}.json'.format(key))
+        self._ttl = ttl
+
+    def load(self):
+        if self._ttl <= 0 or not os.path.isfile(self._path):
+            return None
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            log_to_file('ignoring wspace catalog {}: {}'.format(self._path, e))
+            return None
+        if time.time() - data.get('time', 0) > self._ttl:
+            return None
+        return data
+
+    def write(self, data):
+        make_sure_path_exists(os.path.dirname(self._path))
+        temp = '{}.{}.tmp'.format(self._path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(data, f)
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        os.rename(temp, self._path)
+
+    def save(self, wspaces, principal):
+        if self._ttl > 0:
+            self.write({'time': time.time(), 'principal': principal, 'wspaces': wspaces})
+
+    def update(self, old_name, entry=None, principal=''):
+        # keeps a fresh catalog in step with our own mkws/chws/rmws
+        data = self.load()
+        if data is None:
+            return
+        data['wspaces'] = [e for e in data['wspaces'] if e['Name'] != old_name]
+        if entry:
+            data['wspaces'].append(entry)
+        if principal:
+            data['principal'] = principal
+        self.write(data)
+
+    def invalidate(self):
+        if os.path.exists(self._path):
+            log_to_file('invalidating wspace catalog {}'.format(self._path))
+            os.remove(self._path)
+
+
 class WspaceParser(handler.ContentHandler):
-    def __init__(self, depot, ws_top, server, auth_opt=''):
+    def __init__(self, depot, ws_top, server, auth_opt='', catalog_ttl=0):
         self._wspaces = set()
         self._principal = ''
         self._ws_top = ws_top.replace('\\', '/').strip('"')
@@ -402,7 +1581,18 @@ class WspaceParser(handler.ContentHandler):
         #logging.debug('incoming ws_top={}'.format(ws_top))
         #logging.debug('WspaceParser._ws_top={}'.format(self._ws_top))
         #logging.debug('target: host={}, depot={}, drive={}, path={}'.format(self._host, self._depot, self._ws_drive, self._ws_path))
-        run_ac_async('show -fix wspaces', lambda f: parse(f, self), self._server, self._auth_opt)
+        self._catalog = WspaceCatalog(server, auth_opt, catalog_ttl)
+        self._entries = []
+        data = self._catalog.load()
+        self._from_catalog = data is not None
+        if self._from_catalog:
+            log_to_file('using wspace catalog from {}'.format(time.ctime(data['time'])))
+            for entry in data['wspaces']:
+                self.add_wspace(entry)
+            self._principal = data.get('principal') or self._principal
+        else:
+            run_ac_async('show -fix wspaces', lambda f: parse(f, self), self._server, self._auth_opt)
+            self._catalog.save(self._entries, self._principal)
 
     def __repr__(self):
         repStr  = '\t_wspaces: {}\n'.format(self._wspaces)
@@ -418,28 +1608,33 @@ class WspaceParser(handler.ContentHandler):
 
     def startElement(self, name, attr):
         if name == 'Element':
-            ws_name = attr.getValue('Name')
-            self._principal = attr.getValue('user_name')
-
-            host = attr.getValue('Host')
-            storage = attr.getValue('Storage').replace('\\', '/')
-            drive, path = os.path.splitdrive(storage)
-            drive = drive.lower()
-            depot = attr.getValue('depot')
-            hidden = ('true' == attr.get('hidden'))
-            match = (host == self._host and depot == self._depot and
-                     drive == self._ws_drive and path == self._ws_path)
-            #logging.debug('host={}, depot={}, drive={}, path={}'.format(host, depot, drive, path))
-            if match and not (self._reusable_ws and not self._reusable_ws_hidden):
-                # replace the previous match if it was hidden
-                if self._reusable_ws:
-                    self._wspaces.add(self._reusable_ws)
-
-                self._reusable_ws = ws_name
-                self._reusable_ws_hidden = hidden
-            else:
-                # either not a match or already found a non-hidden match
-                self._wspaces.add(ws_name)
+            entry = dict((key, attr.get(key, '')) for key in WspaceCatalog.ATTRS)
+            self._entries.append(entry)
+            self.add_wspace(entry)
+
+    def add_wspace(self, entry):
+        ws_name = entry['Name']
+        self._principal = entry['user_name']
+
+        host = entry['Host']
+        storage = entry['Storage'].replace('\\', '/')
+        drive, path = os.path.splitdrive(storage)
+        drive = drive.lower()
+        depot = entry['depot']
+        hidden = ('true' == entry['hidden'])
+        match = (host == self._host and depot == self._depot and
+                 drive == self._ws_drive and path == self._ws_path)
+        #logging.debug('host={}, depot={}, drive={}, path={}'.format(host, depot, drive, path))
+        if match and not (self._reusable_ws and not self._reusable_ws_hidden):
+            # replace the previous match if it was hidden
+            if self._reusable_ws:
+                self._wspaces.add(self._reusable_ws)
+
+            self._reusable_ws = ws_name
+            self._reusable_ws_hidden = hidden
+        else:
+            # either not a match or already found a non-hidden match
+            self._wspaces.add(ws_name)
 
     def characters(self, ch):
         pass
@@ -451,6 +1646,7 @@ class WspaceParser(handler.ContentHandler):
         if(self._principal == ''):
             info = InfoParser('', self._server, self._auth_opt, get_principal=True)
             self._principal = info.get_principal()
+            self._catalog.update('', principal=self._principal)
 
         ws_name = '{}.{}_{}'.format(stream, alias, self._principal)
         n = 1
@@ -511,6 +1707,7 @@ class ElemVersParser(handler.ContentHandler):
     def __init__(self, trans, stream, elem_list, server, auth_opt=''):
         self._trans = 'now' if not trans else trans
         self._elem_ver = {}
+        self._elem_paths = {} # eid -> path
 
         out = run_ac('stat -fex -t {} -s "{}" -l {}'.format(self._trans, stream, elem_list), server, auth_opt)
         out = out.encode('utf-8')
@@ -525,6 +1722,7 @@ class ElemVersParser(handler.ContentHandler):
                 if eid and ver:
                     anc_stream, anc_ver = ver.replace('\\', '/').split('/')
                     self._elem_ver[eid] = (anc_stream, anc_ver)
+                    self._elem_paths[eid] = attr.get('location', '')
                     #logging.debug('[from ElemVer] eid = {}, version = {}'.format(eid, ver))
 
     def characters(self, content):
@@ -557,6 +1755,7 @@ class HistParser(handler.ContentHandler):
     # this figures out the last weorkspace version for the specified elements
     def __init__(self, commit_id, stream, elem_list, server, auth_opt=''):
         self._elem_ver = {}
+        self._elem_paths = {} # eid -> path
         self._eid = ''
         self._version = ''
         query = '-c {}'.format(commit_id) if commit_id else '-tnow'
@@ -570,19 +1769,12 @@ class HistParser(handler.ContentHandler):
                 with open(elem_list, 'r') as f:
                     elems = f.read().lstrip(codecs.BOM_UTF8)  # remove the UTF-8 encoding at the beginning of file
                 elems = elems.split('\n')
-                unfound_elems = err.split('\n')
+                unfound_elems = get_error_paths(err, NO_ELEMENT_NAMED)
                 log_to_file('[Unfound elements]: {}'.format(unfound_elems))
                 log_to_file('[elems]: {}'.format(elems))
-                # 'No element named /' (additional length + 2, for space and backslash)
-                start_index = len(NO_ELEMENT_NAMED) + 2
-                for elem in unfound_elems:
-                    if elem.startswith(NO_ELEMENT_NAMED):
-                        elem = elem[start_index:].strip()
-                        if elem in elems:
-                            elems.remove(elem)
-
-                # remove empty elements from list
-                elems = [i for i in elems if i.strip()]
+
+                # remove unfound and empty elements from list
+                elems = [i for i in elems if i.strip() and i not in unfound_elems]
                 log_to_file('[updated elems]: {}'.format(elems))
                 if elems:
                     temp_list = tempfile.NamedTemporaryFile(delete=False)
@@ -603,6 +1795,7 @@ class HistParser(handler.ContentHandler):
     def startElement(self, name, attr):
         if name == 'element':
             self._eid = attr.getValue('id')
+            self._elem_paths[self._eid] = attr.get('path', '')
         elif name == 'version':
             if not self._version:
                 self._version = attr.getValue('real')
@@ -652,6 +1845,22 @@ class StreamParser(handler.ContentHandler):
     def endElement(self, name):
         pass
 
+class StreamChainParser(handler.ContentHandler):
+    # a stream and the streams above it, the only ones whose changes reach it
+    def __init__(self, stream, server, auth_opt=''):
+        self._streams = set()
+        out = run_ac('show -fx -s "{}" -r streams'.format(stream), server, auth_opt)
+        if out:
+            parseString(out, self)
+
+    def startElement(self, name, attr):
+        if name == 'stream':
+            self._streams.add(attr.getValue('name'))
+    def characters(self, ch):
+        pass
+    def endElement(self, name):
+        pass
+
 class RemoteParser(object):
     def __init__(self, alias, url):
         self._server = ''
@@ -664,16 +1873,20 @@ class RemoteParser(object):
         # 'git ls-remote accurev::<url>' will invoke us with alias being accurev::<url>
         self._alias = self._stream if '://' in alias else alias
 
-        self._blob = {} # dictionary
-        self._marks = {} # git marks
+        self._blobs = None # BlobSpool of the push in progress
+        self._squash = False # push all commits as one keep, see do_export
+        self._squash_pending = None # commits folded but not yet applied
+        self._query_pool = None # threads for server queries of a push, see run_queries
+        self._elem_vers_cache = None # ElemVersCache of the push in progress
+        self._marks = MarksStore() # git marks
         self._submods = {} # submodule SHAs
-        self._commit_shas = {} # epoch_time to commit_sha
+        self._push_shas = {} # commit marks of this push to commit_sha
+        self._unpushed = None # (author, committer) to the local commits not in accurev, see find_pushed_commit
         self._prefix = 'refs/accurev/%s' % self._alias
         self._ws_top = ''
         self._git_marks = '' # path to the git mark file
         self._submodIDs = '' # path to submodule ID file
         self._git_marks_loaded = False
-        self._commit_shas_loaded_from_time = False
         self._tmp_git_marks_loaded = False
         self._tmp_git_marks = '' # path to temp git mark file
         self._gitdir = os.environ.get('GIT_DIR', None)
@@ -685,6 +1898,10 @@ class RemoteParser(object):
         self._auth_opt = ''
         self._promote_comment = '' # file with promote comment(s)
         self._isCPKGuiDisabled = False
+        self._wspace_catalog = None # cached wspace list of the server, set on clone
+        self._wspace_entry = None # our wspace as listed in that catalog
+        self._commit_trans = None # CommitTransIndex of the tracking ref
+        self._pushed_commits = [] # shas of the commits of this push
         if self._gitdir:
             self._gitdir = os.path.realpath(self._gitdir) # always use a full path
             self._gitdir = r'{}'.format(self._gitdir)
@@ -693,6 +1910,7 @@ class RemoteParser(object):
             self._git_marks = r'{}'.format(os.path.join(self._ws_top.strip('"'), r'.accurev/git-marks'))
             self._submodIDs = r'{}'.format(os.path.join(self._ws_top.strip('"'), r'.acsubmoduleIDs'))
             self._tmp_git_marks = r'{}'.format(os.path.join(self._ws_top.strip('"'), r'.accurev/git-marks.tmp'))
+            self._commit_trans = CommitTransIndex(os.path.join(self._ws_top.strip('"'), '.accurev', 'commit-trans'))
             log_to_file('GIT_DIR=%s, WS_TOP=%s, GIT marks=%s' % (self._gitdir, self._ws_top, self._git_marks))
             self._repo = pygit2.Repository(self._gitdir)
 
@@ -719,15 +1937,19 @@ class RemoteParser(object):
                                 log_to_file('[authtoken]: {}'.format(self._auth_token))
                                 self._auth_opt = '-A {} '.format(self._auth_token)
 
+        # so that a recorded session can be replayed in another repo
+        ac_executor.mask(self._auth_token, '<token>')
+        ac_executor.mask(self._server, '<server>')
+        if self._gitdir:
+            ac_executor.mask(self._ws_top.strip('"'), '<wstop>')
+            ac_executor.mask(self._gitdir, '<gitdir>')
+
     def __repr__(self):
         repStr  = '\t_server:    {}\n'.format(self._server)
         repStr += '\t_stream:    {}\n'.format(self._stream)
         repStr += '\t_path:      {}\n'.format(self._path)
         repStr += '\t_reroot:    {}\n'.format(self._reroot)
-        repStr += '\t_blob:{'
-        for i in sorted(self._blob):
-            repStr += '\n    {}: {}'.format(i, self._blob[i])
-        repStr += '\t}\n'
+        repStr += '\t_blobs:     {}\n'.format(self._blobs)
         repStr += '\t_submods:{'
         for i in sorted(self._submods):
             repStr += '\n    {}: {}'.format(i, self._submods[i])
@@ -738,10 +1960,7 @@ class RemoteParser(object):
         repStr += '\t_git_marks: {}\n'.format(self._git_marks)
         repStr += '\t_submodIDs: {}\n'.format(self._submodIDs)
         repStr += '\t_repo:      {}\n'.format(self._repo)
-        repStr += '\t_marks:{'
-        for i in sorted(self._marks):
-            repStr += '\n    {}: {}'.format(i, self._marks[i])
-        repStr += '\t}\n'
+        repStr += '\t_marks:     {}\n'.format(self._marks)
         repStr += '\t_tmp_git_marks: {}\n'.format(self._tmp_git_marks)
         repStr += '\t_git_marks_loaded: {}\n'.format(self._git_marks_loaded)
         repStr += '\t_tmp_git_marks_loaded: {}\n'.format(self._tmp_git_marks_loaded)
@@ -846,7 +2065,7 @@ class RemoteParser(object):
         mark = self.parse_mark(line)
 
         line = self.next() # data
-        self._blob[mark] = self.parse_data(line)
+        self._blobs.read(mark, int(line.split(' ')[1]), sys.stdin)
         self.next() # blank line
 
     def addSubID(self, file, shaID):
@@ -862,12 +2081,26 @@ class RemoteParser(object):
                 f.write('{} {}\n'.format(file, shaID))
         f.close()
 
-    def detect_move(self, defunct_list, full_path):
+    def index_defuncts(self, defunct_list):
+        # git blob id -> the popped files to defunct with that content
+        index = collections.defaultdict(collections.deque)
         for old_path in defunct_list:
             # full_old_path = r'{}'.format(os.path.join( r'{}'.format(self._ws_top.strip('"')), r'{}'.format(old_path)))
             full_old_path = os.path.join(self._ws_top.strip('"'), old_path.decode('utf8'))
-            if filecmp.cmp(full_old_path, full_path, shallow=False):
-                return old_path
+            if os.path.isfile(full_old_path):
+                index[str(pygit2.hashfile(full_old_path))].append(old_path)
+        return index
+
+    def detect_move(self, move_index, full_path, blob_id=None):
+        # returns a file to defunct with the same content, if any;
+        # blob_id is the git id of the new file when it is already known
+        if not move_index:
+            return ''
+        if not blob_id:
+            blob_id = str(pygit2.hashfile(full_path))
+        old_paths = move_index.get(blob_id)
+        if old_paths:
+            return old_paths.popleft()
         return ''
     
     def exec_op(self, op, elem_list, comments):
@@ -887,19 +2120,12 @@ class RemoteParser(object):
                 if err.startswith(ELEMENT_ALREADY_EXISTS):
                     # these files are already added, so we remove it from the elem_list and 'add' them again
                     # e.g. Element already exists: /git_automation/git_cpk/smoke/common/One_trigger-One_trigger_condition-Multiple_queries.xml
-                    added_files = err.split('\n')
+                    added_files = get_error_paths(err, ELEMENT_ALREADY_EXISTS)
                     log_to_file('[already added files]: {}'.format(added_files))
                     log_to_file('[element list]: {}'.format(elem_list))
-                    # Element already exists: / (include space & backslash length)
-                    start_index = len(ELEMENT_ALREADY_EXISTS) + 2
-                    for elem in added_files:
-                        if elem.startswith(ELEMENT_ALREADY_EXISTS):
-                            elem = elem[start_index:].strip()
-                            if elem in elem_list:
-                                elem_list.remove(elem)
                     os.remove(temp.name)
-                    # remove empty elements from list
-                    elem_list = [i for i in elem_list if i.strip()]
+                    # remove added and empty elements from list
+                    elem_list = [i for i in elem_list if i.strip() and i not in added_files]
                     log_to_file('[updated element list]: {}'.format(elem_list))
                     if elem_list:
                         temp = tempfile.NamedTemporaryFile(delete=False)
@@ -925,11 +2151,7 @@ class RemoteParser(object):
 
     def load_marks_from_file(self, filename):
         log_to_file('loading marks from file: {}'.format(filename))
-        with open(filename) as marks:
-            for mark in marks:
-                m, h = mark.split()
-                self._marks[m.strip()] = h.strip()
-                logging.debug('mark {}, commit_sha {}'.format(m.strip(), h.strip()))
+        self._marks.load(filename)
 
     def load_git_marks(self):
         if not self._git_marks_loaded:
@@ -940,6 +2162,37 @@ class RemoteParser(object):
             self.load_marks_from_file(self._tmp_git_marks)
             self._tmp_git_marks_loaded = True
 
+    def compact_marks(self):
+        # 'accurev.marks.compact' is how large the git marks file may grow
+        # before a fetch drops the marks of objects not reachable from a
+        # ref; only commit marks are asked for once their stream is done
+        limit = get_git_config_size('accurev.marks.compact', 0, repo=self._repo)
+        if not limit or not os.path.exists(self._git_marks) or os.path.getsize(self._git_marks) <= limit:
+            return
+        reachable = set()
+        walker = self.walk_refs()
+        if walker is not None:
+            reachable.update(str(commit.id) for commit in walker)
+
+        kept = dropped = 0
+        temp = '{}.compact'.format(self._git_marks)
+        with open(self._git_marks, 'rb') as f:
+            with open(temp, 'wb') as out:
+                for line in f:
+                    if line.split(' ', 1)[-1].strip() in reachable:
+                        out.write(line)
+                        kept += 1
+                    else:
+                        dropped += 1
+        os.remove(self._git_marks)
+        os.rename(temp, self._git_marks)
+        log_to_file('compacted the git marks, {} kept, {} dropped'.format(kept, dropped))
+
+    def resolve_commit_trans(self):
+        if self._commit_trans.has_pending() and os.path.exists(self._git_marks):
+            self.load_git_marks()
+            self._commit_trans.resolve(self._marks, self._repo)
+
     def get_stream_elem_vers(self, commit_trans, stream, elem_list):
         elem_vers_parser = ElemVersParser(commit_trans, stream, elem_list, self._server, self._auth_opt)
         return elem_vers_parser._elem_ver
@@ -949,22 +2202,83 @@ class RemoteParser(object):
             commit_id = ''
             if commit_mark in self._marks:
                 commit_id = self._marks[commit_mark]
-                # Using pygit2 instead of 'git log' cmd
-                # out, _, _ = run_cmd('git log --format=%B -n 1 {}'.format(commit_id))
-                commit = self._repo.get(commit_id, None)
-                out = commit.message if commit else ''
-                trans = get_update_trans_from_commit_message(depot, out)
+                trans = self._commit_trans.get_trans(depot, commit_id)
+                if trans is None:
+                    # not in the index, a clone from before it or a commit made elsewhere
+                    # Using pygit2 instead of 'git log' cmd
+                    # out, _, _ = run_cmd('git log --format=%B -n 1 {}'.format(commit_id))
+                    commit = self._repo.get(commit_id, None)
+                    out = commit.message if commit else ''
+                    trans = get_update_trans_from_commit_message(depot, out)
+                    if commit:
+                        self._commit_trans.add([(commit_id, '{}:{}'.format(depot, trans) if trans else '-')])
                 if trans:
-                    return self.get_stream_elem_vers(trans, self._stream, elem_list)
+                    return self.get_cached_elem_vers(('trans', self._stream, trans), elem_list,
+                        lambda l: ElemVersParser(trans, self._stream, l, self._server, self._auth_opt))
 
             ws_name = get_git_config('accurev.{}.wsname'.format(self._alias), repo=self._repo)
-            hist = HistParser(commit_id, ws_name, elem_list, self._server, self._auth_opt)
-            return hist._elem_ver
+            if not commit_id:
+                # the wspace as it is now, which changes during the push
+                hist = HistParser(commit_id, ws_name, elem_list, self._server, self._auth_opt)
+                return hist._elem_ver
+            return self.get_cached_elem_vers(('commit', ws_name, commit_id), elem_list,
+                lambda l: HistParser(commit_id, ws_name, l, self._server, self._auth_opt))
         else:
             # the commit from: mark is missing for the 1st push!!!
             # the basis is alwyas the clone transaction
-            trans = get_initial_update_trans('{}/heads/master'.format(self._prefix), depot)
-            return self.get_stream_elem_vers(trans, self._stream, elem_list)
+            trans = self._commit_trans.get_trans(depot, 'root')
+            if trans is None:
+                trans = get_initial_update_trans('{}/heads/master'.format(self._prefix), depot)
+                if trans:
+                    self._commit_trans.add([('root', '{}:{}'.format(depot, trans))])
+            if not trans:
+                return self.get_stream_elem_vers(trans, self._stream, elem_list)
+            return self.get_cached_elem_vers(('trans', self._stream, trans), elem_list,
+                lambda l: ElemVersParser(trans, self._stream, l, self._server, self._auth_opt))
+
+    def get_cached_elem_vers(self, basis, elem_list, query):
+        # eid -> version of the elements in the file 'elem_list' at a fixed
+        # basis; only the elements not in the cache are passed to 'query',
+        # which returns a parser with _elem_ver and _elem_paths
+        cache = self._elem_vers_cache
+        with open(elem_list, 'rb') as f:
+            paths = [l.strip() for l in f.read().lstrip(codecs.BOM_UTF8).split('\n') if l.strip()]
+        elem_ver = {}
+        missing = []
+        for path in paths:
+            found, value = cache.get(basis, path)
+            if not found:
+                missing.append(path)
+            elif value:
+                eid, ver = value
+                elem_ver[eid] = ver
+        if not missing:
+            return elem_ver
+
+        temp = tempfile.NamedTemporaryFile(delete=False)
+        temp.write(codecs.BOM_UTF8)
+        for path in missing:
+            temp.write('{}\n'.format(path))
+        temp.close()
+        parser = query(temp.name)
+        os.remove(temp.name)
+
+        asked = set(missing)
+        answered = set()
+        for eid, ver in parser._elem_ver.items():
+            elem_ver[eid] = ver
+            path = self.normalizePath(parser._elem_paths.get(eid, '').encode('utf-8')).lstrip('/')
+            if path.startswith('./'):
+                path = path[2:]
+            if path in asked:
+                cache.put(basis, path, (eid, ver))
+                answered.add(path)
+        if len(answered) == len(parser._elem_ver):
+            # every answer was matched to its path, so the rest have no
+            # version at this basis
+            for path in asked - answered:
+                cache.put(basis, path, None)
+        return elem_ver
 
     def do_keeps(self, depot, keep_list, comment, commit_from_mark, merge_from_mark):
         if not keep_list:
@@ -976,10 +2290,10 @@ class RemoteParser(object):
             temp.write('{}\n'.format(elem.strip()))
         temp.close()
 
-        direct_anc = self.get_commit_elem_vers(depot, commit_from_mark, temp.name)
-        merge_anc = {}
-        if merge_from_mark:
-            merge_anc = self.get_commit_elem_vers(depot, merge_from_mark, temp.name)
+        # both ancestors are looked up at the same time
+        direct_anc, merge_anc = self.run_queries(
+            lambda: self.get_commit_elem_vers(depot, commit_from_mark, temp.name),
+            lambda: self.get_commit_elem_vers(depot, merge_from_mark, temp.name) if merge_from_mark else {})
 
         # run the stat to detect modified files
         temp_mod = tempfile.NamedTemporaryFile(delete=False, mode='w+b')
@@ -998,32 +2312,100 @@ class RemoteParser(object):
             self._trigger_promote = True # keep op if files are modified
         os.remove(temp_mod.name)
 
-    def get_all_commit_shas_since_time(self, epoch):
-        out, _, _ = run_cmd('git --no-pager log --all --pretty=format:"%H %cd" --since="{}" --date=raw'.format(epoch))
-        self._commit_shas_loaded_from_time = True
-        for eachline in out.splitlines():
-            commit_sha = eachline.split()[0]
-            epoch = ' '.join(eachline.split()[1:])
-            self._commit_shas[epoch] = commit_sha
+    def walk_refs(self, prefix=''):
+        # a walker over the commits of every ref starting with 'prefix' (tags
+        # peeled) and a detached HEAD, None if there are none
+        tips = []
+        for name in self._repo.listall_references():
+            if not name.startswith(prefix):
+                continue
+            try:
+                tips.append(self._repo.lookup_reference(name).peel(pygit2.Commit).id)
+            except Exception:
+                pass # not a commit
+        if self._repo.head_is_detached:
+            tips.append(self._repo.head.target)
+        if not tips:
+            return None
+        walker = self._repo.walk(tips[0], pygit2.GIT_SORT_NONE)
+        for tip in tips[1:]:
+            walker.push(tip)
+        return walker
+
+    def load_unpushed_commits(self):
+        # the commits of the local branches that are not in the tracking ref,
+        # by their author and committer lines as fast-export writes them.
+        # the export stream only names the remote branch, so any local branch
+        # may be the one pushed, but notes, stashes, tags and other remotes
+        # are not
+        self._unpushed = {}
+        walker = self.walk_refs('refs/heads/')
+        if walker is None:
+            return
+        tracking = self.get_tip_ref()
+        if tracking:
+            walker.hide(pygit2.Oid(hex=tracking))
+        for commit in walker:
+            headers, _, message = commit.read_raw().partition('\n\n')
+            author = committer = ''
+            for header in headers.split('\n'):
+                if header.startswith('author '):
+                    author = header.strip()
+                elif header.startswith('committer '):
+                    committer = header.strip()
+            parents = [str(parent_id) for parent_id in commit.parent_ids]
+            self._unpushed.setdefault((author, committer), []).append((str(commit.id), parents, message))
+        log_to_file('{} local commit(s) not in accurev'.format(sum(len(c) for c in self._unpushed.values())))
+
+    def find_pushed_commit(self, author, committer, message, parents):
+        # the sha of a pushed commit whose mark git has not written yet,
+        # 'parents' is None when the shas of its parents are not all known
+        if self._unpushed is None:
+            self.load_unpushed_commits()
+        candidates = self._unpushed.get((author, committer), [])
+        if parents is not None:
+            # a commit with other parents is not this one, however alike
+            candidates = [c for c in candidates if c[1] == parents]
+        matches = set(sha for sha, _, msg in candidates if msg == message)
+        if not matches:
+            # fast-export re-encodes messages that are not UTF-8
+            matches = set(sha for sha, _, _ in candidates)
+        if len(matches) == 1:
+            return matches.pop()
+        log_to_file('{} local commit(s) match {}'.format(len(matches), committer))
+        return ''
 
-    def parse_commit(self, depot, root, dry_run):
+    def get_mark_sha(self, mark):
+        if not mark.startswith(':'):
+            return mark
+        return self._marks.get(mark) or self._push_shas.get(mark)
+
+    def read_commit(self):
+        # reads a commit block of the export stream into a dict with the
+        # keep comment lines, the from/merge marks and the file operations
         # insome use cases, the tmp git marks file is not created
         # in time for the commit so we check and load the marks
         # if it has not been done
         self.load_git_marks()
 
         elem_list = [] # full list in its natural order
-        tmp_comment = tempfile.NamedTemporaryFile(delete=False)
-        # make the tmp_comment file as UTF-8 and add "@@Content-Encoding: utf-8"
-        tmp_comment.write(codecs.BOM_UTF8)
-        tmp_comment.write('@@Content-Encoding: utf-8\n')
+        commit_marks = set() # blobs used by this commit
+        comment_lines = [] # lines of the keep comment
 
         commit_sha = ''
+        commit_mark = ''
         commit_from_mark = ''
         merge_from_mark = ''
+        author_line = ''
+        committer_line = ''
+        message = ''
+        sha_index = 0 # where the commit sha goes in the keep comment
         for line in self:
             if self.check('mark'):
                 commit_mark = line.split()[1]
+                if not self._tmp_git_marks_loaded:
+                    # fast-export only marks what is not in the marks file it read
+                    self._marks.set_new(commit_mark)
                 commit_sha = self._marks.get(commit_mark)
                 log_to_file('commit_sha obtained for commit_mark {} - {}'.format(commit_mark, commit_sha))
             elif self.check('author'):
@@ -1031,37 +2413,21 @@ class RemoteParser(object):
                 epoch = '{} {}'.format(line.split()[-2], line.split()[-1])
                 ac_time = epoch_time_to_accurev_time(int(epoch.split()[0]))
                 comment = '[git commit]: {} {}\n'.format(' '.join(line.split()[:-2]), ac_time)
-                tmp_comment.write(comment)
+                comment_lines.append(comment)
+                author_line = line
                 #tmp_comment.write('[git commit]: {}\n'.format(line))
             elif self.check('committer'):
                 # 'committer' (SP <name>)? SP LT <email> GT SP <when> LF
                 epoch = '{} {}'.format(line.split()[-2], line.split()[-1])
                 ac_time = epoch_time_to_accurev_time(int(epoch.split()[0]))
                 comment = '[git commit]: {} {}\n'.format(' '.join(line.split()[:-2]), ac_time)
-                tmp_comment.write(comment)
-
-                if not commit_sha:
-                    log_to_file('commit_sha not found, computing it from time')
-                    # commit mark is not yet in the git marks file
-                    # committer time should have a lower chance of collision
-                    # than the author time
-                    if not self._commit_shas_loaded_from_time:
-                        self.get_all_commit_shas_since_time(epoch)
-                    commit_sha = self._commit_shas.get(epoch)
-                    log_to_file('commit_sha found from time: {}'.format(commit_sha))
-
-                if commit_sha:
-                    comment = '[git commit]: {}\n'.format(commit_sha)
-                    tmp_comment.write(comment)
-                    log_to_file('commit: {}'.format(commit_sha))
-                else:
-                    log_to_file('commit_sha not added to the KEEP comment. Failing this push.')
-                    toGit('error refs/heads/master failed to get commit sha')
-                    sys.exit(1)
-
+                comment_lines.append(comment)
+                committer_line = line
+                sha_index = len(comment_lines)
             elif self.check('data'):
                 comment = self.parse_data(line)
-                tmp_comment.write(comment)
+                message = comment
+                comment_lines.append(comment)
                 self._promote_comment.write('[git commit]: {}'.format(comment))
             elif self.check('from'):
                 # the from mark specifies the basis for this commit
@@ -1097,17 +2463,95 @@ class RemoteParser(object):
                 op, perm, mark, path = line.split(' ', 3)
                 if perm == '160000':     # git submodule directory
                     self._submods[path] = mark
+                else:
+                    commit_marks.add(mark.strip(':'))
                 # modify or add
                 elem_list.append(line)
             else:
                 log_to_file('unrecognized line in commit block: %s' % line)
-        
-        tmp_comment.close()
-        
+
+        if not commit_sha:
+            log_to_file('commit_sha not found, looking it up in the local commits')
+            # commit mark is not yet in the git marks file
+            parents = None
+            if commit_from_mark:
+                parents = [self.get_mark_sha(m) for m in (commit_from_mark, merge_from_mark) if m]
+                if not all(parents):
+                    parents = None
+            commit_sha = self.find_pushed_commit(author_line, committer_line, message, parents)
+            log_to_file('commit_sha found in the local commits: {}'.format(commit_sha))
+            if commit_sha and commit_mark:
+                self._push_shas[commit_mark] = commit_sha
+
+        if commit_sha:
+            comment = '[git commit]: {}\n'.format(commit_sha)
+            comment_lines.insert(sha_index, comment)
+            log_to_file('commit: {}'.format(commit_sha))
+        else:
+            log_to_file('commit_sha not added to the KEEP comment. Failing this push.')
+            toGit('error refs/heads/master failed to get commit sha')
+            sys.exit(1)
+
+        return {'sha': commit_sha, 'comment': comment_lines, 'from': commit_from_mark, 'merge': merge_from_mark,
+                'elems': elem_list, 'marks': commit_marks}
+
+    def parse_commit(self, depot, root, dry_run):
+        commit = self.read_commit()
         if dry_run:
             # return empty commit SHA
             return ''
 
+        if self._squash and not commit['merge']:
+            self.squash_commit(commit, root)
+        else:
+            # a merge is applied on its own, after the commits before it
+            self.flush_squash(depot)
+            defunct_list, add_keep_list, move_list, blob_ids = self.write_commit_files(commit, root)
+            self.apply_changes(depot, defunct_list, add_keep_list, move_list, blob_ids,
+                               commit['comment'], commit['from'], commit['merge'])
+        return commit['sha']
+
+    def squash_commit(self, commit, root):
+        # folds the commit into the pending squash; its files are written
+        # to the wspace now so that its blobs can be released
+        if self._squash_pending is None:
+            self._squash_pending = {'from': commit['from'], 'comment': [], 'plan': PushPlan(), 'blobs': {}, 'count': 0}
+        squash = self._squash_pending
+        squash['comment'].extend(commit['comment'])
+        squash['count'] += 1
+
+        defunct_list, add_keep_list, move_list, blob_ids = self.write_commit_files(commit, root)
+        squash['blobs'].update(blob_ids)
+        # the net change is applied as adds and defuncts,
+        # moves among them are found by content
+        defunct_list.extend(old_path for old_path, _ in move_list)
+        written = set(add_keep_list)
+        for path in defunct_list:
+            squash['plan'].set(path, 'defunct')
+            if path not in written:
+                # written by an earlier commit of the squash
+                full_path = os.path.join(self._ws_top.strip('"'), path.decode('utf8'))
+                if os.path.isfile(full_path):
+                    os.remove(full_path)
+        for path in add_keep_list:
+            squash['plan'].set(path, 'keep')
+
+    def flush_squash(self, depot):
+        # applies the net change of the squashed commits in one go
+        squash = self._squash_pending
+        if squash is None:
+            return
+        self._squash_pending = None
+        log_to_file('applying {} squashed commits'.format(squash['count']))
+        defunct_list = squash['plan'].paths('defunct')
+        add_keep_list = squash['plan'].paths('keep')
+        self.apply_changes(depot, defunct_list, add_keep_list, [], squash['blobs'], squash['comment'], squash['from'], '')
+
+    def write_commit_files(self, commit, root):
+        # writes the files of the commit to the wspace, returns the paths
+        # to defunct and the paths to add or keep
+        elem_list = commit['elems']
+
         # if commit_sha:
         #     ws_name = get_git_config('accurev.{}.wsname'.format(self._alias), repo=self._repo)
         #     histExistsParser = HistExistsParser(commit_sha, ws_name, self._server)
@@ -1124,34 +2568,68 @@ class RemoteParser(object):
         # extract all deletes
         defunct_list = []
         add_keep_list = []
+        move_list = [] # (old path, new path)
+        blob_ids = {} # path -> git blob id, to find moves
+        renames = self.find_renames(commit)
+        renamed = set(renames.values())
+        dir_moved = set() # files that move with their directory
+        for old_dir, new_dir, files in self.find_dir_moves(commit, renames):
+            ws_old_dir = self.get_ws_path(old_dir, root)
+            ws_new_dir = self.get_ws_path(new_dir, root)
+            if ws_old_dir and ws_new_dir:
+                # one move for the whole directory
+                move_list.append((ws_old_dir, ws_new_dir))
+                dir_moved.update(files)
         for elem in elem_list:
             p = elem.split()
             op = p[0]
+            old_path = ''
             if op == 'D':
                 # delete: 'D' SP <path> LF
                 _, path = elem.split(' ', 1)
                 #path = p[1]
                 path = c_style_unescape(path)
+                if path in renamed:
+                    # moved, see the add of its new path
+                    continue
             elif op == 'M':
                 # modify: 'M' SP <mode> SP <dataref> SP <path> LF
                 # dataref: either a mark ref (:idnum) or SHA-1
                 _, _, _, path = elem.split(' ', 3)
                 #path = p[3]
                 path = c_style_unescape(path)
+                old_path = renames.get(path, '')
+                if path in dir_moved:
+                    old_path = ''
+            elif op in ('R', 'C'):
+                # rename/copy: 'R'/'C' SP <path> SP <path> LF
+                # the new path gets the blob of the old path
+                source, path = split_path_pair(elem[2:])
+                source = c_style_unescape(source)
+                path = c_style_unescape(path)
+                entry = self.get_parent_entry(commit, source)
+                if entry is None:
+                    log_to_file('operation not supported: {}'.format(elem))
+                    continue
+                p = [op, '{:o}'.format(entry.filemode), str(entry.id)]
+                if op == 'R':
+                    old_path = source
             else:
                 # other operations are not yet supported
                 log_to_file('operation not supported: {}'.format(elem))
                 continue
 
-            if self._reroot:
-                path = r'{}'.format(os.path.join(root, r'{}'.format(path)))
-            elif not path.startswith(root):
-                # changes from outside our namespace
-                log_to_file('skipping {}'.format(r'{}'.format(path)))
+            if old_path:
+                old_path = self.get_ws_path(old_path, root)
+            path = self.get_ws_path(path, root)
+            if not path:
+                # a move out of our namespace is a defunct
+                if old_path:
+                    defunct_list.append(old_path)
                 continue
 
             if op == 'D':
-                defunct_list.append(r'{}'.format(path))
+                defunct_list.append(path)
             else:
                 mark = p[2].strip(':')
                 #logging.debug('op = %s, mark = %s, path = %s' % (op, mark, r'{}'.format(path)))
@@ -1165,6 +2643,10 @@ class RemoteParser(object):
 
                 full_path = os.path.join(self._ws_top.strip('"'), path.decode('utf8'))
                 add_keep_list.append(path)
+                blob_id = self.get_blob_id(mark)
+                blob_ids[self.normalizePath(path)] = blob_id
+                if old_path:
+                    move_list.append((old_path, path))
                 # git does not instruct us to create the directories
                 # so we need to ensure that the path exists before writing to the file
                 dir_path = os.path.dirname(full_path)
@@ -1172,75 +2654,306 @@ class RemoteParser(object):
                 # with open(full_path, 'wb+') as f:
                 #     f.write(self._blob[mark])
                 with open(os.path.join(self._ws_top.strip('"'), path.decode('utf8')), 'wb+') as f:
-                    f.write(self._blob[mark])
-
-        if defunct_list:
-            # since we don't keep the files around in the workspace
-            # and files on this list are either to be defuncted
-            # or to be renamed, so they need to be on disk
-            tmp_pop = tempfile.NamedTemporaryFile(delete=False)
-            tmp_pop.write(codecs.BOM_UTF8)  # changes the file to UTF-8-BOM
-            for elem in defunct_list:
-                tmp_pop.write('{}\n'.format(elem.strip()))
-            tmp_pop.close()
-            pop_out, pop_error, pop_ret = run_ac_ignore_error('pop -l {} -L {}'.format(tmp_pop.name, self._ws_top), self._server, self._auth_opt)
-            if pop_ret != 0:
-                NO_ELEMENT_NAMED = 'No element named'
-                if pop_error.startswith(NO_ELEMENT_NAMED):
-                    # these files are already defuncted, so we remove it from the defunct_list
-                    # e.g. No element named /ProxyUI/src/app/data/aclGroupMembers.ts
-                    defuncted_files = pop_error.split('\n')
-                    log_to_file('[already defuncted files]: {}'.format(defuncted_files))
-                    log_to_file('[defunct list]: {}'.format(defunct_list))
-                    # No element named / (include space & backslash length)
-                    start_index = len(NO_ELEMENT_NAMED) + 2
-                    for elem in defuncted_files:
-                        if (elem.startswith(NO_ELEMENT_NAMED)):
-                            elem = elem[start_index:].strip()
-                            if elem in defunct_list:
-                                defunct_list.remove(elem)
-
-                    # remove empty elements from list
-                    defunct_list = [i for i in defunct_list if i.strip()]
-                    log_to_file('[updated defunct list]: {}'.format(defunct_list))
-
-                    os.remove(tmp_pop.name)
-                    if defunct_list:
-                        tmp_pop = tempfile.NamedTemporaryFile(delete=False)
-                        tmp_pop.write(codecs.BOM_UTF8)  # changes the file to UTF-8-BOM
-                        for elem in defunct_list:
-                            tmp_pop.write('{}\n'.format(elem.strip()))
-                        tmp_pop.close()
-                        run_ac('pop -l {} -L {}'.format(tmp_pop.name, self._ws_top), self._server, self._auth_opt)
+                    self._blobs.write_to(mark, f, blob_id)
+
+        # the blobs are in the wspace now, a later commit that uses
+        # the same mark gets it from the repo
+        for mark in commit['marks']:
+            self._blobs.release(mark)
+        return defunct_list, add_keep_list, move_list, blob_ids
+
+    def get_blob_id(self, mark):
+        # the git id of the blob of a file line: a blob of this stream, one
+        # fast-export only refers to by its mark in the marks file (content
+        # that was imported before), or a git id given as is
+        sha = self._blobs.sha(mark)
+        if sha:
+            return sha
+        if not (mark.isdigit() and len(mark) < 40):
+            return mark
+        sha = self._marks.get(':{}'.format(mark))
+        if not sha or sha not in self._repo:
+            log_to_file('blob mark :{} is not in this stream or the marks file'.format(mark))
+            toGit('error refs/heads/master unknown blob mark :{}'.format(mark))
+            sys.exit(1)
+        return sha
+
+    def get_ws_path(self, path, root):
+        # the wspace path of a path in the repo, '' if it is not in our namespace
+        if self._reroot:
+            return r'{}'.format(os.path.join(root, r'{}'.format(path)))
+        if not path.startswith(root):
+            # changes from outside our namespace
+            log_to_file('skipping {}'.format(r'{}'.format(path)))
+            return ''
+        return r'{}'.format(path)
+
+    def find_renames(self, commit):
+        # git runs fast-export without -M, so a rename arrives as a delete
+        # and an add; returns new path -> old path of the exact renames
+        renames = {}
+        if not commit['sha'] or not any(elem.startswith('D ') for elem in commit['elems']):
+            return renames
+        git_commit = self._repo.get(commit['sha'])
+        if git_commit is None or len(git_commit.parents) != 1:
+            return renames
+        diff = self._repo.diff(git_commit.parents[0], git_commit)
+        diff.find_similar(flags=pygit2.GIT_DIFF_FIND_RENAMES | pygit2.GIT_DIFF_FIND_EXACT_MATCH_ONLY)
+        for delta in diff.deltas:
+            if delta.status == pygit2.GIT_DELTA_RENAMED and delta.new_file.mode != pygit2.GIT_FILEMODE_COMMIT:
+                renames[_to_native(delta.new_file.path)] = _to_native(delta.old_file.path)
+        return renames
+
+    def find_dir_moves(self, commit, renames):
+        # directories of the parent whose files all move to the same new
+        # directory, as (old dir, new dir, new paths of the files); the old
+        # directory must be gone from the commit, moving it would take
+        # along whatever the commit writes there
+        if not renames:
+            return []
+        git_commit = self._repo.get(commit['sha'])
+        parent_tree = git_commit.parents[0].tree
+        tree = git_commit.tree
+        files = collections.defaultdict(set)
+        for path, old_path in renames.items():
+            old_parts = old_path.split('/')
+            parts = path.split('/')
+            # each shared trailing name is a pair of directories
+            # the file could have moved with
+            n = 1
+            while n < min(len(old_parts), len(parts)) and old_parts[-n] == parts[-n]:
+                files[('/'.join(old_parts[:-n]), '/'.join(parts[:-n]))].add(path)
+                n += 1
+
+        dir_moves = []
+        # outermost directories first
+        for old_dir, new_dir in sorted(files, key=lambda d: d[0].count('/')):
+            if (old_dir + '/').startswith(new_dir + '/') or (new_dir + '/').startswith(old_dir + '/'):
+                continue
+            if any(old_dir.startswith(d[0] + '/') for d in dir_moves):
+                continue
+            if self.count_tree_files(parent_tree, new_dir) is None and \
+               self.count_tree_files(parent_tree, old_dir) == len(files[(old_dir, new_dir)]) and \
+               not self.tree_has_path(tree, old_dir):
+                dir_moves.append((old_dir, new_dir, files[(old_dir, new_dir)]))
+        return dir_moves
+
+    def tree_has_path(self, tree, path):
+        try:
+            tree[_to_text(path)]
+        except KeyError:
+            return False
+        return True
+
+    def count_tree_files(self, tree, path):
+        # the number of files under 'path' in the tree, None if it is not there
+        try:
+            entry = tree[_to_text(path)]
+        except KeyError:
+            return None
+        if entry.filemode != pygit2.GIT_FILEMODE_TREE:
+            return None
+        n = 0
+        subtrees = [self._repo[entry.id]]
+        while subtrees:
+            for entry in subtrees.pop():
+                if entry.filemode == pygit2.GIT_FILEMODE_TREE:
+                    subtrees.append(self._repo[entry.id])
                 else:
-                    display_accurev_error(pop_error)
-                    sys.exit(1)
-            try:
+                    n += 1
+        return n
+
+    def get_parent_entry(self, commit, path):
+        # the tree entry of 'path' before the commit
+        git_commit = self._repo.get(commit['sha']) if commit['sha'] else None
+        if git_commit is None or not git_commit.parents:
+            return None
+        try:
+            return git_commit.parents[0].tree[_to_text(path)]
+        except KeyError:
+            return None
+
+    def move_elems(self, move_list, comment):
+        # runs the moves of a commit; a move that fails is reported and
+        # returned so that it can be pushed as a defunct and an add, which
+        # starts a new element without the history of the old one
+        failed = []
+        for old_path, path in move_list:
+            temp_move = self.write_move_xml(old_path, path, comment)
+            _, err, ret = run_ac_xml_ignore_error(temp_move)
+            os.remove(temp_move)
+            if ret != 0:
+                log_to_file('[move failed]: {} -> {}: {}'.format(old_path, path, err.strip()))
+                toStdErr('warning: accurev could not move {} to {}: {}\n'
+                         'warning: pushing it as a new element, its history stays with {}\n'.format(
+                             old_path, path, ' '.join(err.split()), old_path))
+                failed.append((old_path, path))
+            else:
+                self._trigger_promote = True # move op
+        if failed:
+            log_to_file('{} of {} moves failed'.format(len(failed), len(move_list)))
+        return failed
+
+    def write_move_xml(self, old_path, path, comment):
+        # 'accurev xml -l tempfile' instead of cmd line
+        # to support Non-ASCII names
+        temp_move = tempfile.NamedTemporaryFile(delete=False)
+        temp_move.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        temp_move.write('<AcCommand command="move">\n')
+        if self._server:
+            temp_move.write('<arg>-H</arg>\n')
+            temp_move.write('<arg>{}</arg>\n'.format(self._server))
+        if self._auth_token:
+            temp_move.write('<arg>-A</arg>\n')
+            temp_move.write('<arg>{}</arg>\n'.format(self._auth_token))
+        temp_move.write('<arg>-L</arg>\n')
+        temp_move.write('<arg>{}</arg>\n'.format(self._ws_top.strip('"')))
+
+        temp_move.write('<arg>-c</arg>\n')
+        temp_move.write('<arg>@{}</arg>\n'.format(comment))
+
+        temp_move.write('<arg>{}</arg>\n'.format(old_path))
+        temp_move.write('<arg>{}</arg>\n'.format(path))
+        temp_move.write('</AcCommand>')
+
+        temp_move.close()
+        return temp_move.name
+
+    def pop_defuncts(self, defunct_list):
+        # returns the files that accurev has no element for
+        defuncted_files = set()
+        if not defunct_list:
+            return defuncted_files
+        # since we don't keep the files around in the workspace
+        # and files on this list are either to be defuncted
+        # or to be renamed, so they need to be on disk
+        tmp_pop = tempfile.NamedTemporaryFile(delete=False)
+        tmp_pop.write(codecs.BOM_UTF8)  # changes the file to UTF-8-BOM
+        for elem in defunct_list:
+            tmp_pop.write('{}\n'.format(elem.strip()))
+        tmp_pop.close()
+        pop_out, pop_error, pop_ret = run_ac_ignore_error('pop -l {} -L {}'.format(tmp_pop.name, self._ws_top), self._server, self._auth_opt)
+        if pop_ret != 0:
+            NO_ELEMENT_NAMED = 'No element named'
+            if pop_error.startswith(NO_ELEMENT_NAMED):
+                # these files are already defuncted, so we remove it from the defunct_list
+                # e.g. No element named /ProxyUI/src/app/data/aclGroupMembers.ts
+                defuncted_files = get_error_paths(pop_error, NO_ELEMENT_NAMED)
+                log_to_file('[already defuncted files]: {}'.format(defuncted_files))
+                # remove defuncted and empty elements from list
+                defunct_list = [i for i in defunct_list if i.strip() and i not in defuncted_files]
+                log_to_file('[updated defunct list]: {}'.format(defunct_list))
+
                 os.remove(tmp_pop.name)
-            except:
-                pass
+                if defunct_list:
+                    tmp_pop = tempfile.NamedTemporaryFile(delete=False)
+                    tmp_pop.write(codecs.BOM_UTF8)  # changes the file to UTF-8-BOM
+                    for elem in defunct_list:
+                        tmp_pop.write('{}\n'.format(elem.strip()))
+                    tmp_pop.close()
+                    run_ac('pop -l {} -L {}'.format(tmp_pop.name, self._ws_top), self._server, self._auth_opt)
+            else:
+                display_accurev_error(pop_error)
+                sys.exit(1)
+        try:
+            os.remove(tmp_pop.name)
+        except:
+            pass
+        return defuncted_files
 
-        add_list = []
-        keep_list = []
-        if add_keep_list:
-            tmp_stat = tempfile.NamedTemporaryFile(delete=False)
-            tmp_stat.write(codecs.BOM_UTF8)
-            for elem in add_keep_list:
-                elem = self.normalizePath(elem)
-                keep_list.append(elem)
-                tmp_stat.write('{}\n'.format(elem))
-            tmp_stat.close()
+    def get_external_files(self, elem_list):
+        tmp_stat = tempfile.NamedTemporaryFile(delete=False)
+        tmp_stat.write(codecs.BOM_UTF8)
+        for elem in elem_list:
+            tmp_stat.write('{}\n'.format(elem))
+        tmp_stat.close()
 
-            #logging.debug(keep_list)
+        # replacing cmd output with StatusParser
+        status_parser = StatusParser(tmp_stat.name, self._ws_top, self._server, self._auth_opt)
+        status_parser.get_external_files()
+        # out = run_ac('stat -x -l {} -L {}'.format(tmp_stat.name, self._ws_top),
+        #              self._server)
+        os.remove(tmp_stat.name)
+        return status_parser._elem_list
+
+    def get_defunct_files(self, elem_list):
+        tmp_keep = tempfile.NamedTemporaryFile(delete=False)
+        tmp_keep.write(codecs.BOM_UTF8)  # changes the file to UTF-8-BOM
+        for elem in elem_list:
+            tmp_keep.write('{}\n'.format(elem.strip()))
+        tmp_keep.close()
+        sparser = StatusParser(tmp_keep.name, self._ws_top, self._server, self._auth_opt)
+        sparser.get_defunct_files()
+        os.remove(tmp_keep.name)
+        return [self.normalizePath(elem[0].encode('utf-8')) for elem in sparser._elem_list]
+
+    def run_queries(self, *queries):
+        # runs independent server queries side by side and returns their
+        # results in order; 'accurev.push.queryjobs' is how many run at
+        # once, 1 runs them one after another
+        if self._query_pool is None:
+            jobs = get_git_config_int('accurev.push.queryjobs', 3, repo=self._repo)
+            self._query_pool = ThreadPool(jobs) if jobs > 1 else False
+        if not self._query_pool:
+            return [query() for query in queries]
+        results = [self._query_pool.apply_async(exit_safe(query)) for query in queries]
+        try:
+            return [result.get() for result in results]
+        except WorkerExit as e:
+            self._query_pool.terminate()
+            sys.exit(e.code)
 
-            # replacing cmd output with StatusParser
-            status_parser = StatusParser(tmp_stat.name, self._ws_top, self._server, self._auth_opt)
-            status_parser.get_external_files()
-            out = status_parser._elem_list
+    def apply_changes(self, depot, defunct_list, add_keep_list, move_list, blob_ids, comment, commit_from_mark, merge_from_mark):
+        # runs the accurev ops for one commit, or for a squash of commits
+        tmp_comment = tempfile.NamedTemporaryFile(delete=False)
+        # make the tmp_comment file as UTF-8 and add "@@Content-Encoding: utf-8"
+        tmp_comment.write(codecs.BOM_UTF8)
+        tmp_comment.write('@@Content-Encoding: utf-8\n')
+        for line in comment:
+            tmp_comment.write(line)
+        tmp_comment.close()
 
-            # out = run_ac('stat -x -l {} -L {}'.format(tmp_stat.name, self._ws_top),
-            #              self._server)
-            os.remove(tmp_stat.name)
+        plan = PushPlan()
+        for path in defunct_list:
+            plan.set(path, 'defunct')
+        for path in add_keep_list:
+            plan.set(self.normalizePath(path), 'keep')
+
+        # renames from git, the new file (or directory) goes back to its
+        # old path for the move; the files stay on the keep list in case
+        # accurev has different content at the old path
+        ws_top = self._ws_top.strip('"')
+        for old_path, path in move_list:
+            full_old_path = os.path.join(ws_top, old_path.decode('utf8'))
+            make_sure_path_exists(os.path.dirname(full_old_path))
+            if os.path.isdir(full_old_path):
+                shutil.rmtree(full_old_path)
+            elif os.path.exists(full_old_path):
+                os.remove(full_old_path)
+            os.rename(os.path.join(ws_top, path.decode('utf8')), full_old_path)
+        for old_path, path in self.move_elems(move_list, tmp_comment.name):
+            # the files are added at the new path instead
+            os.rename(os.path.join(ws_top, old_path.decode('utf8')), os.path.join(ws_top, path.decode('utf8')))
+            plan.set(old_path, 'defunct')
+
+        # the pop of the files to defunct, 'stat -x' and 'stat -D' of the
+        # files to keep do not depend on each other, run them together
+        # before any defunct/add/keep; our ops do not change the defunct
+        # state of the files to keep, so 'stat -D' can go first
+        keep_list = plan.paths('keep')
+        defuncted_files, out, defunct_elems = self.run_queries(
+            lambda: self.pop_defuncts(plan.paths('defunct')),
+            lambda: self.get_external_files(keep_list) if keep_list else [],
+            lambda: self.get_defunct_files(keep_list) if keep_list else [])
+        for elem in defuncted_files:
+            plan.discard(elem)
+
+        if keep_list:
+            #logging.debug(keep_list)
+            # the files to defunct by content, external files with
+            # the same content are moves
+            move_index = self.index_defuncts(plan.paths('defunct')) if out else None
+            detected_moves = []
             for elem in out:
                 # new file or part of a rename
                 # logging.debug(elem)
@@ -1249,71 +2962,43 @@ class RemoteParser(object):
                 path = self.normalizePath(path)
                 status = elem[1]
                 full_path = os.path.join(self._ws_top.strip('"'), path.decode('utf8'))
-                old_path = self.detect_move(defunct_list, full_path)
-                # TODO: removing from a list is slow, have to find a different way to do this!!!
+                old_path = self.detect_move(move_index, full_path, blob_ids.get(path))
 
                 # logging.debug('path = %s; old_path = %s; full_path = %s' % (path, old_path, full_path))
                 if old_path:
-                    os.remove(full_path)
-
-                    # 'accurev xml -l tempfile' instead of cmd line
-                    # to support Non-ASCII names
-                    temp_move = tempfile.NamedTemporaryFile(delete=False)
-                    temp_move.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-                    temp_move.write('<AcCommand command="move">\n')
-                    if self._server:
-                        temp_move.write('<arg>-H</arg>\n')
-                        temp_move.write('<arg>{}</arg>\n'.format(self._server))
-                    if self._auth_token:
-                        temp_move.write('<arg>-A</arg>\n')
-                        temp_move.write('<arg>{}</arg>\n'.format(self._auth_token))
-                    temp_move.write('<arg>-L</arg>\n')
-                    temp_move.write('<arg>{}</arg>\n'.format(self._ws_top.strip('"')))
-
-                    temp_move.write('<arg>-c</arg>\n')
-                    temp_move.write('<arg>@{}</arg>\n'.format(tmp_comment.name))
-
-                    temp_move.write('<arg>{}</arg>\n'.format(old_path))
-                    temp_move.write('<arg>{}</arg>\n'.format(path))
-                    temp_move.write('</AcCommand>')
-
-                    temp_move.close()
-                    run_ac_xml(temp_move.name)
-                    self._trigger_promote = True # move op
-
-                    #run_ac('move -c @{} {} {} -L {}'.format(tmp_comment.name, old_path, path, self._ws_top), self._server)
-                    defunct_list.remove(old_path)
-                    keep_list.remove(path)
-                    #logging.debug('removing "{}" from keep_list'.format(path))
-                    os.remove(temp_move.name)
+                    detected_moves.append((old_path, path))
+                    plan.set(path, 'move')
+                else:
+                    plan.set(path, 'add')
+
+            # the popped old file is the one that gets moved
+            for old_path, path in detected_moves:
+                os.remove(os.path.join(self._ws_top.strip('"'), path.decode('utf8')))
+            failed = set(self.move_elems(detected_moves, tmp_comment.name))
+            for old_path, path in detected_moves:
+                if (old_path, path) in failed:
+                    # same content, so the new file is a copy of the old one
+                    shutil.copyfile(os.path.join(self._ws_top.strip('"'), old_path.decode('utf8')),
+                                    os.path.join(self._ws_top.strip('"'), path.decode('utf8')))
+                    plan.set(path, 'add')
                 else:
-                    add_list.append(path)
-                    keep_list.remove(path)
-                    #logging.debug('removing "{}" from keep_list'.format(path))
+                    #run_ac('move -c @{} {} {} -L {}'.format(tmp_comment.name, old_path, path, self._ws_top), self._server)
+                    plan.discard(old_path)
+                    plan.discard(path)
 
-        self.exec_op('defunct', defunct_list, tmp_comment.name)
-        self.exec_op('add', add_list, tmp_comment.name)
+        self.exec_op('defunct', plan.paths('defunct'), tmp_comment.name)
+        self.exec_op('add', plan.paths('add'), tmp_comment.name)
+        keep_list = plan.paths('keep')
         #logging.debug(keep_list)
 
         # make sure you undefunct the already 'defunct' files in the keep list
         # since the file is neither detected as move nor as an external file
         if keep_list:
-            tmp_keep = tempfile.NamedTemporaryFile(delete=False)
-            tmp_keep.write(codecs.BOM_UTF8)  # changes the file to UTF-8-BOM
-            for elem in keep_list:
-                tmp_keep.write('{}\n'.format(elem.strip()))
-            tmp_keep.close()
-            sparser = StatusParser(tmp_keep.name, self._ws_top, self._server, self._auth_opt)
-            sparser.get_defunct_files()
-            os.remove(tmp_keep.name)
-            defunct_elems = sparser._elem_list
+            defunct_elems = [path for path in defunct_elems if plan.get(path) == 'keep']
             if defunct_elems:
                 tmp_undefunct = tempfile.NamedTemporaryFile(delete=False)
                 tmp_undefunct.write(codecs.BOM_UTF8)  # changes the file to UTF-8-BOM
-                for elem in defunct_elems:
-                    path = elem[0]
-                    path = path.encode('utf-8')
-                    path = self.normalizePath(path)
+                for path in defunct_elems:
                     tmp_undefunct.write('{}\n'.format(path.strip()))
                 tmp_undefunct.close()
                 run_ac_ignore_error('undefunct -c @{} -l {} -L {}'.format(tmp_comment.name, tmp_undefunct.name, self._ws_top), self._server, self._auth_opt)
@@ -1321,19 +3006,16 @@ class RemoteParser(object):
 
         self.do_keeps(depot, keep_list, tmp_comment.name, commit_from_mark, merge_from_mark)
         os.remove(tmp_comment.name)
-        return commit_sha
 
     def parse_export(self, depot):
         #
         first_commit_sha = ''
         commit_sha = ''
         dry_run = False
-        first_commit_or_reset = True
         fail_this_push = False
         disallowed_local_branch = False
-        called_incoming_changes = False
         err_msg = 'error not-supported'
-        root = ''
+        root = None
 
         self.next()
         for line in self:
@@ -1350,30 +3032,19 @@ class RemoteParser(object):
                     disallowed_local_branch = True
                     dry_run = True
                     fail_this_push = True
-
-                # one time initialization
-                if first_commit_or_reset:
-                    first_commit_or_reset = False
-                    if not fail_this_push:
-                        self.remove_all_members('push')
-                        root = r'{}'.format(self.get_root())
-
-                    # check if there are incoming changes
-                    if not called_incoming_changes:
-                        called_incoming_changes = True
-                        if self.has_incoming_changes():
-                            log_to_file('backing has changes not in local')
-                            dry_run = True
-                            fail_this_push = True
-                            err_msg = 'error refs/heads/master fetch first'
+                elif root is None:
+                    # a push to another branch leaves the wspace alone
+                    root = self.prepare_push()
 
                 if self.check('commit'):
                     commit_sha = self.parse_commit(depot, root, dry_run)
+                    self._pushed_commits.append(commit_sha)
                     if not first_commit_sha:
                         first_commit_sha = commit_sha
             elif self.check('from'):
                 self.next() # LF
             elif self.check('done'):
+                self.flush_squash(depot)
                 break
             else:
                 sys.exit('Unrecognized command in export block: [%s]' % line)
@@ -1384,8 +3055,7 @@ class RemoteParser(object):
                                       " checkout the master branch,\n"
                                       " merge from {name}, then push again or\n"
                                       " push to the remote master branch\n".format(name=remote_branch))
-                # displays both remote branch error and fetch first error
-                # so exit, if it is remote branch error
+                # this fails the push before prepare_push touches the wspace
                 toGit('error not-supported')
                 sys.exit(1)
 
@@ -1396,6 +3066,11 @@ class RemoteParser(object):
 
         return first_commit_sha, commit_sha
 
+    def prepare_push(self):
+        # cleans up after a failed push, returns the root of the wspace
+        self.remove_all_members('push')
+        return r'{}'.format(self.get_root())
+
     def has_incoming_changes(self):
         # Since update will ignore member files
         # run 'stat -o' to expose incoming changes
@@ -1413,8 +3088,31 @@ class RemoteParser(object):
         self._promote_comment.write(codecs.BOM_UTF8)
         self._promote_comment.write('@@Content-Encoding: utf-8\n')
 
+        # 'accurev.push.blobmemory' is how much blob data of a push is kept in memory
+        blob_memory = get_git_config_size('accurev.push.blobmemory', 64 * 1024 * 1024, repo=self._repo)
+        self._blobs = BlobSpool(self._repo, blob_memory)
+        # 'accurev.push.elemcache' is how many element versions are remembered
+        self._elem_vers_cache = ElemVersCache(get_git_config_int('accurev.push.elemcache', 100000, repo=self._repo))
+        # 'git push -o squash' or 'accurev.push.squash' applies the pushed
+        # commits as one change instead of one keep per commit
+        if get_git_config('accurev.push.squash', repo=self._repo) == 'true':
+            self._squash = True
+
         depot = self.get_depot()
+        # the checks for incoming changes only read from the server, so they
+        # run before the stream; a push that would fail reads none of its blobs
+        if self.has_incoming_changes():
+            log_to_file('backing has changes not in local')
+            toGit('error refs/heads/master fetch first')
+            sys.exit(1)
+        self.resolve_commit_trans()
         first_commit, last_commit = self.parse_export(depot)
+        log_to_file('[blobs]: {}'.format(self._blobs))
+        log_to_file('[element versions]: {}'.format(self._elem_vers_cache))
+        self._blobs.close()
+        if self._query_pool:
+            self._query_pool.close()
+            self._query_pool.join()
         if not last_commit:
             # no-op push; nothing to do
             # print('ok refs/heads/master')
@@ -1457,6 +3155,7 @@ class RemoteParser(object):
 
             cmdline = 'accurev promote{}{}-k -c @{} {} -L {}'.format(server_opt, self._auth_opt, self._promote_comment.name, cpk, self._ws_top)
             log_to_file('[cmd] {}'.format(cmdline))
+            promote_start = time.time()
 
             if sys.platform == 'win32':
                 p = subprocess.Popen(cmdline, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
@@ -1499,6 +3198,7 @@ class RemoteParser(object):
                         if os.path.isfile(full_path):
                             os.remove(full_path)
             p.wait() # wait for the subprocess to exit
+            ac_executor.account('promote', time.time() - promote_start)
             os.remove(self._promote_comment.name)
             if p.returncode:
                 err = p.stderr.read()
@@ -1518,6 +3218,8 @@ class RemoteParser(object):
             os.remove(self._promote_comment.name)
         except:
             log_to_file('Failed to remove file or file is already removed: {}'.format(self._promote_comment.name))
+        # a later push based on these commits finds their keeps
+        self._commit_trans.add([(sha, '-') for sha in self._pushed_commits])
         # success
         toGit('ok refs/heads/master')
         toGit('')
@@ -1584,44 +3286,385 @@ class RemoteParser(object):
             set_git_config('accurev.{}.depot'.format(self._alias), depot, self._repo)
         return depot
     
+    def get_clone_batches(self, jobs, max_scratch):
+        elem_parser = ElemListParser(self._ws_top, self._server, self._auth_opt)
+        if max_scratch:
+            # each of the concurrent slices gets its share of the scratch space
+            batches = split_by_size(elem_parser._files, elem_parser._sizes, max(1, max_scratch // jobs))
+        else:
+            batches = split_namespace(elem_parser._files, jobs * 4)
+        log_to_file('populating {} files in {} batches'.format(len(elem_parser._files), len(batches)))
+        return batches
+
     def get_ws_name(self):
         ws_name = get_git_config('accurev.{}.wsname'.format(self._alias), repo=self._repo)
         return ws_name
 
+    def new_update_parser(self, ref_head, mark=1):
+        # 'accurev.import.odb' writes the blobs straight into the object database
+        odb_repo = self._repo if get_git_config('accurev.import.odb', repo=self._repo) == 'true' else None
+        odb_threads = get_git_config_int('accurev.import.odbthreads', 4, repo=self._repo)
+        # only worth hashing the files when git may already have some of them
+        dedupe_repo = None
+        parent_tree = None
+        if not self._repo.is_empty and get_git_config('accurev.import.dedupe', repo=self._repo) != 'false':
+            dedupe_repo = self._repo
+            if ref_head:
+                parent_tree = self._repo[ref_head].tree
+        # 'accurev.import.queuesize' bounds the elements parsed ahead of git, 0 turns the pipeline off
+        queue_size = get_git_config_int('accurev.import.queuesize', 256, repo=self._repo)
+        # 'accurev.import.journalsize' is the memory for the element list before it spills to disk
+        journal_limit = get_git_config_size('accurev.import.journalsize', 64 * 1024 * 1024, repo=self._repo)
+        update_parser = UpdateParser(self._ws_top, self._reroot, self._server, auth_opt=self._auth_opt,
+                                     show_progress=self._show_progress, repo=odb_repo, odb_threads=odb_threads,
+                                     dedupe_repo=dedupe_repo, parent_tree=parent_tree, queue_size=queue_size,
+                                     journal_limit=journal_limit)
+        # marks must not be reused while earlier commits of this import may still refer to them
+        update_parser._mark = mark
+        return update_parser
+
+    def write_import_commit(self, update_parser, depot, trans, from_ref, trans_hist=None, reset=True, deleteall=False,
+                            batch=None):
+        # writes the commit for the elements of update_parser, returns its mark
+        # 'batch' is the (trans, user) of every transaction in the commit
+        if update_parser._deduped:
+            log_to_file('{} file(s) already in git, not sent again'.format(update_parser._deduped))
+        commit_mark = update_parser._mark
+        if reset:
+            toGit('reset %s/heads/master' % self._prefix)
+        toGit('commit %s/heads/master' % self._prefix)
+        toGit('mark :{}'.format(commit_mark))
+        # the sha of the commit is only known once git writes its marks
+        index_entries = [(':{}'.format(commit_mark), '{}:{}'.format(depot, trans))]
+        if not from_ref:
+            index_entries.append(('root', '{}:{}'.format(depot, trans)))
+        self._commit_trans.add(index_entries)
+
+        tz_offset = get_tz_offset()
+        if trans_hist:
+            commit_time = int(trans_hist.time)
+            # ('author' (SP <name>)? SP LT <email> GT SP <when> LF)?
+            # 'committer' (SP <name>)? SP LT <email> GT SP <when> LF
+            toGit('author {} <{}> {} {}'.format(trans_hist.user, '@accurev.com', commit_time, tz_offset))
+            toGit('committer {} <{}> {} {}'.format(trans_hist.user, '@accurev.com', commit_time, tz_offset))
+
+            comments = 'import from accurev @ {}:{}\n[{}: {}]'.format(depot, trans, trans_hist.type, trans_hist.comment)
+            if batch and len(batch) > 1:
+                comments += '\n[transactions: {}]'.format(', '.join('{} ({})'.format(t, u) for t, u in batch))
+        else:
+            # to differentiate changes from the real user in 'git blame'
+            principal = 'others'
+            commit_time = int(time.time())
+            # ('author' (SP <name>)? SP LT <email> GT SP <when> LF)?
+            # 'committer' (SP <name>)? SP LT <email> GT SP <when> LF
+            toGit('author {} <{}> {} {}'.format(principal, '@.com', commit_time, tz_offset))
+            toGit('committer {} <{}> {} {}'.format(principal, '@.com', commit_time, tz_offset))
+
+            comments = 'import from accurev @ {}:{}'.format(depot, trans)
+
+        toGit('data {}'.format(len(comments)))
+        toGit(comments)
+        if from_ref:
+            toGit('from {}'.format(from_ref))
+        if deleteall:
+            toGit('deleteall')
+
+        for elem in update_parser._elem_list:
+            #logging.debug(elem)
+            toGit(elem)
+        update_parser._elem_list.close()
+        return commit_mark
+
+    def get_imported_trans(self, depot, ref_head):
+        # the last transaction whose changes are all in git, as told by the
+        # tip of the tracking ref; the recorded watermark can be ahead of the
+        # tip when the last updates were empty, but only counts while the
+        # tip is still the commit it was recorded for
+        trans = self.get_commit_trans(depot, ref_head)
+        watermark = get_git_config('accurev.{}.importtrans'.format(self._alias), repo=self._repo).split()
+        if len(watermark) == 3 and watermark[0].startswith(':'):
+            watermark = self.resolve_watermark(depot, *watermark)
+        if len(watermark) == 2 and watermark[0] == ref_head and watermark[1].isdigit() and \
+                (not trans or int(watermark[1]) > int(trans)):
+            trans = watermark[1]
+        return trans
+
+    def set_imported_trans(self, ref_head, trans, commit_trans=''):
+        # '<tip sha> <trans>', the tip must be a commit git already has, or
+        # '<:mark> <trans> <commit trans>' for the last commit of this import
+        # until git has written its marks
+        value = ' '.join(v for v in (ref_head, trans, commit_trans) if v)
+        set_git_config('accurev.{}.importtrans'.format(self._alias), value, repo=self._repo)
+
+    def resolve_watermark(self, depot, mark, trans, commit_trans):
+        # the watermark of the last import, if git stored its last commit;
+        # a mark left by an unfinished fetch names some other commit
+        sha = ''
+        if os.path.exists(self._git_marks):
+            self.load_git_marks()
+            sha = self._marks.get(mark, '')
+        if sha and self.get_commit_trans(depot, sha) == commit_trans:
+            self.set_imported_trans(sha, trans)
+            return [sha, trans]
+        log_to_file('dropping the watermark of an unfinished import: {} {}'.format(mark, trans))
+        set_git_config('accurev.{}.importtrans'.format(self._alias), '', repo=self._repo)
+        return []
+
+    def get_commit_trans(self, depot, sha):
+        trans = self._commit_trans.get_trans(depot, sha)
+        if trans is None:
+            commit = self._repo.get(sha, None)
+            trans = get_update_trans_from_commit_message(depot, commit.message) if commit else ''
+        return trans
+
+    def is_up_to_date(self, depot):
+        # a query for the depot's latest transaction, and if it is newer the
+        # history of the stream chain since the import, instead of a workspace
+        # cleanup, an update and a listing of all the wspaces
+        if get_git_config('accurev.import.watermark', repo=self._repo) == 'false' or \
+                get_git_config('accurev.trans.targettrans', repo=self._repo):
+            return False
+        # the watermark only counts while it was recorded for the current tip,
+        # an interrupted fetch cannot make the next one skip its changes
+        ref_head = self.get_tip_ref()
+        if not ref_head:
+            return False
+        imported_trans = self.get_imported_trans(depot, ref_head)
+        if not imported_trans.isdigit():
+            return False
+        head_trans = DepotHistParser(depot, 'now', self._server, self._auth_opt).get_head_trans()
+        log_to_file('last imported transaction: {}, depot head: {}'.format(imported_trans, head_trans))
+        if not head_trans:
+            return False
+        if int(head_trans) <= int(imported_trans):
+            return True
+        # the depot moved on, but maybe only on streams this one does not see
+        candidates, total, chain = self.get_stream_changes(depot, self.get_ws_name(), head_trans, imported_trans)
+        log_to_file('{} of {} transaction(s) after {} on {}'.format(
+            len(candidates), total, imported_trans, ', '.join(sorted(chain))))
+        if candidates:
+            return False
+        # the tip shows the stream as of the depot head, so that the next
+        # fetch only looks at what comes after it
+        self.set_imported_trans(ref_head, head_trans)
+        return True
+
+    def get_stream_changes(self, depot, ws_name, head_trans, last_trans):
+        # the transactions after 'last_trans' up to 'head_trans' that change
+        # what the wspace sees: those of its stream and the streams above it,
+        # as a sorted list of (trans, user), with the number of transactions
+        # looked at and the stream chain
+        chain = StreamChainParser(ws_name, self._server, self._auth_opt)._streams
+        hist = DepotHistParser(depot, '{}-{}'.format(head_trans, int(last_trans) + 1), self._server, self._auth_opt)
+        candidates = sorted((int(t), user) for t, kind, stream, user in hist._transactions
+                            if kind in CONTENT_TRANS_KINDS and (not stream or not chain or stream in chain))
+        return candidates, len(hist._transactions), chain
+
+    def do_incremental_import(self, depot, ref_head, last_trans, trans_batch):
+        # imports one commit per 'trans_batch' transactions instead of a single
+        # commit for everything since the last fetch. fast-import saves its refs
+        # and marks after each of them, so that an interrupted fetch resumes
+        # from the last commit it wrote
+        root = self.get_root()
+        from_ref = ref_head
+        mark = 1
+        first = True
+        commit_trans = '' # of the last commit written
+
+        ws_name = self.get_ws_name()
+        ws_trans = UpdateTransParser(self._server, self._auth_opt, ws_name).get_update_trans(ws_name)
+        if ws_trans and int(ws_trans) > int(last_trans):
+            # the wspace was updated by an interrupted fetch but its changes
+            # never made it into git, so import its whole content again
+            log_to_file('wspace is at {}, git only has {}: importing all files'.format(ws_trans, last_trans))
+            update_parser = self.new_update_parser('', mark)
+            update_parser.do_pop(root)
+            update_parser.close()
+            mark = self.write_import_commit(update_parser, depot, ws_trans, from_ref, deleteall=True)
+            toGit('checkpoint')
+            from_ref = ':{}'.format(mark)
+            mark += 1
+            first = False
+            last_trans = ws_trans
+            commit_trans = ws_trans
+
+        head_trans = DepotHistParser(depot, 'now', self._server, self._auth_opt).get_head_trans()
+        if not head_trans or int(head_trans) <= int(last_trans):
+            log_to_file('no transactions after {}'.format(last_trans))
+            steps = []
+        else:
+            candidates, total, chain = self.get_stream_changes(depot, ws_name, head_trans, last_trans)
+            # (trans to update to, the (trans, user) of the changes it brings)
+            steps = [(batch[-1][0], batch) for batch in
+                     (candidates[i:i + trans_batch] for i in range(0, len(candidates), trans_batch))]
+            if not steps or steps[-1][0] != int(head_trans):
+                steps.append((int(head_trans), []))
+            log_to_file('importing {} in {} step(s), {} of {} transaction(s) on {}'.format(
+                head_trans, len(steps), len(candidates), total, ', '.join(sorted(chain))))
+
+        for n, (trans, batch) in enumerate(steps):
+            trans = str(trans)
+            update_parser = self.new_update_parser(ref_head if first else '', mark)
+            update_parser.do_update_with_trans(root, trans)
+            update_parser.close()
+            if update_parser._elem_list:
+                # the author is that of the last change in the step
+                trans_hist = TransHistParser(str(batch[-1][0]) if batch else trans, depot, self._server, self._auth_opt)
+                mark = self.write_import_commit(update_parser, depot, trans, from_ref, trans_hist, reset=first,
+                                                batch=batch)
+                toGit('checkpoint')
+                from_ref = ':{}'.format(mark)
+                first = False
+                mark += 1
+                commit_trans = trans
+            else:
+                update_parser._elem_list.close()
+                mark = update_parser._mark
+                if first:
+                    # nothing new since the tip, which git already has
+                    self.set_imported_trans(ref_head, trans)
+            if self._show_progress:
+                toStdErr('\rImporting transactions: {}% ({}/{})'.format(int(float(n + 1) / len(steps) * 100), n + 1, len(steps)))
+        if self._show_progress and steps:
+            toStdErr(', done.\n')
+
+        if not first:
+            toGit('')
+            toGit('reset {}/heads/master'.format(self._prefix))
+            toGit('from {}'.format(from_ref))
+            toGit('')
+            if steps and int(steps[-1][0]) > int(commit_trans):
+                # the wspace went on past the last commit with empty updates,
+                # which is not an interrupted fetch for the next one
+                self.set_imported_trans(from_ref, str(steps[-1][0]), commit_trans)
+
+    def create_clone_wspace(self, depot, use_catalog=True):
+        # creates the wspace for a clone, or takes over an old one at the
+        # same location, returns its name and whether it was reused
+        # 'accurev.wscache.ttl' is how long (in seconds) the list of wspaces is cached, 0 turns it off
+        ttl = get_git_config_int('accurev.wscache.ttl', 300, repo=self._repo) if use_catalog else 0
+        ws_parser = WspaceParser(depot, self._ws_top, self._server, self._auth_opt, catalog_ttl=ttl)
+        self._wspace_catalog = ws_parser._catalog
+        ws_name = ws_parser.get_unique_name(self._stream, self._alias)
+        #logging.debug('ws_name: {}\nws_parser:\n{}'.format(ws_name, ws_parser))
+        set_git_config('accurev.{}.wsname'.format(self._alias), ws_name, repo=self._repo)
+        if ws_parser._reusable_ws:
+            # now reuse the wspace
+            log_to_file('Reuse {}wspace: {}'.format('hidden ' if ws_parser._reusable_ws_hidden else '', ws_parser._reusable_ws))
+            make_sure_path_exists(r'{}'.format(self._ws_top.strip('"')))
+            old_ws_name = ws_parser._reusable_ws
+            if ws_parser._reusable_ws_hidden:
+                _, err, ret = run_ac_ignore_error('reactivate wspace "{}"'.format(old_ws_name), self._server, self._auth_opt) # or the following won't work!
+                if ret != 0:
+                    return self.retry_clone_wspace(ws_parser, depot, err)
+
+            _, err, ret = run_ac_ignore_error('chws -w "{}" -b "{}" -e u -l {} {}'.format(old_ws_name, self._stream, self._ws_top, ws_name),
+                                              self._server, self._auth_opt)
+            if ret != 0:
+                return self.retry_clone_wspace(ws_parser, depot, err)
+            self._wspace_entry = self.get_wspace_entry(ws_name, ws_parser._principal, depot)
+            ws_parser._catalog.update(old_ws_name, self._wspace_entry)
+            run_ac('update -9 -L {}'.format(self._ws_top), self._server, self._auth_opt)
+            self.clear_all_rules(ws_name)
+            self.remove_all_members('clone')
+            if self._path:
+                run_ac('incldo -s "{}" /./'.format(ws_name), self._server, self._auth_opt)
+            return ws_name, True
+
+        incl_opt = '-i ' if self._path else ''
+        _, err, ret = run_ac_ignore_error('mkws -w "{}" {}-b "{}" -e u -l {}'.format(ws_name, incl_opt, self._stream, self._ws_top),
+                                          self._server, self._auth_opt)
+        if ret != 0:
+            return self.retry_clone_wspace(ws_parser, depot, err)
+        self._wspace_entry = self.get_wspace_entry(ws_name, ws_parser._principal, depot)
+        ws_parser._catalog.update(ws_name, self._wspace_entry)
+        return ws_name, False
+
+    def retry_clone_wspace(self, ws_parser, depot, err):
+        if not ws_parser._from_catalog:
+            display_accurev_error(err)
+            sys.exit(1)
+        # the cached list of wspaces is out of date, e.g. the name is taken
+        log_to_file('wspace setup failed with a cached wspace list: {}'.format(err.strip()))
+        ws_parser._catalog.invalidate()
+        return self.create_clone_wspace(depot, use_catalog=False)
+
+    def get_wspace_entry(self, ws_name, principal, depot):
+        # a wspace as 'show wspaces' lists it, for the wspace catalog
+        return {'Name': ws_name, 'user_name': principal, 'Host': socket.gethostname(),
+                'Storage': self._ws_top.strip('"'), 'depot': depot, 'hidden': ''}
+
+    def watch_clone(self, update_parser, clone_journal):
+        # record each drained batch in the clone journal
+        update_parser._elem_list.set_tee(clone_journal.open_elems())
+        def on_drained(parser, batch_id):
+            # fast-import saves its packs and marks, after which
+            # the batch is safely in git
+            toGit('checkpoint')
+            sys.stdout.flush()
+            clone_journal.set_done(batch_id)
+        update_parser._on_drained = on_drained
+
+    def resume_clone(self, update_parser, clone_journal, jobs):
+        # reuse what the interrupted clone already sent to git
+        # and populate the batches it did not finish
+        elems = clone_journal.get_elems()
+        if os.path.exists(self._git_marks):
+            self.load_git_marks()
+            self._marks.prefetch(elem.split(' ', 3)[2] for elem in elems)
+        missing = []
+        for elem in elems:
+            _, mode, ref, path = elem.split(' ', 3)
+            if mode != '160000':
+                sha = self._marks.get(ref) if ref.startswith(':') else ref
+                if not sha or sha not in self._repo:
+                    # lost with the last pack of the interrupted clone
+                    missing.append(path)
+                    continue
+                elem = 'M {} {} {}'.format(mode, sha, path)
+            update_parser.add_elem(elem)
+
+        done = clone_journal.get_done()
+        batches = clone_journal.get_batches()
+        if batches:
+            batches = [batch for batch in batches if batch[0] not in done]
+        else:
+            # the clone was not populated in batches, start over
+            batches = [(0, [''])]
+        if missing:
+            if self._reroot and self._path:
+                missing = ['{}/{}'.format(self._path, path) for path in missing]
+            batches.append((-1, missing))
+        log_to_file('resuming clone: {} batch(es) done, {} to go'.format(len(done), len(batches)))
+
+        self.watch_clone(update_parser, clone_journal)
+        update_parser.do_parallel_pop(self._path, batches, jobs, drain=True)
+
     def do_import(self):
         # this can be invoked for 'clone', 'fetch', 'pull', and 'remote update'
         cloning = False
         reuse_ws = False
+        resume_clone = False
+        clone_journal = CloneJournal(os.path.join(self._ws_top.strip('"'), '.accurev', 'clone'))
         #logging.debug('do_import:\nself:\n{}'.format(self))
         depot = self.get_depot()
         if not os.path.exists(r'{}'.format(self._ws_top.strip('"'))):
             # the workspace directory does not exist yet
             # so as long as we don't issue commands that will populate files
             # we should still end up with an empty workspace
-            ws_parser = WspaceParser(depot, self._ws_top, self._server, self._auth_opt)
-            ws_name = ws_parser.get_unique_name(self._stream, self._alias)
-            #logging.debug('ws_name: {}\nws_parser:\n{}'.format(ws_name, ws_parser))
-            set_git_config('accurev.{}.wsname'.format(self._alias), ws_name, repo=self._repo)
-            if ws_parser._reusable_ws:
-                # now reuse the wspace
-                log_to_file('Reuse {}wspace: {}'.format('hidden ' if ws_parser._reusable_ws_hidden else '', ws_parser._reusable_ws))
-                make_sure_path_exists(r'{}'.format(self._ws_top.strip('"')))
-                old_ws_name = ws_parser._reusable_ws
-                if ws_parser._reusable_ws_hidden:
-                    run_ac('reactivate wspace "{}"'.format(old_ws_name), self._server, self._auth_opt) # or the following won't work!
-
-                run_ac('chws -w "{}" -b "{}" -e u -l {} {}'.format(old_ws_name, self._stream, self._ws_top, ws_name),
-                       self._server, self._auth_opt)
-                run_ac('update -9 -L {}'.format(self._ws_top), self._server, self._auth_opt)
-                self.clear_all_rules(ws_name)
-                self.remove_all_members('clone')
-                if self._path:
-                    run_ac('incldo -s "{}" /./'.format(ws_name), self._server, self._auth_opt)
-                reuse_ws = True
-            else:
-                incl_opt = '-i ' if self._path else ''
-                run_ac('mkws -w "{}" {}-b "{}" -e u -l {}'.format(ws_name, incl_opt, self._stream, self._ws_top), self._server, self._auth_opt)
+            ws_name, reuse_ws = self.create_clone_wspace(depot)
             cloning = True
+            clone_journal.start()
+        elif clone_journal.exists() and self.get_tip_ref():
+            # the clone is in git, only its cleanup did not finish
+            log_to_file('removing the journal of a finished clone')
+            clone_journal.remove()
+        elif clone_journal.exists():
+            # the last clone was interrupted, carry on with it
+            log_to_file('resuming the interrupted clone')
+            ws_name = self.get_ws_name()
+            cloning = True
+            resume_clone = True
 
         # here is the reasoning, if a push failed previously leaving kept files
         # in the workspace, and those files have become overlap because there are
@@ -1632,6 +3675,19 @@ class RemoteParser(object):
         # because they are committed in the first place, get it?
         #self.remove_overlap_members()
         # however, it's hard...
+        if not cloning:
+            # before this import reuses the marks of the last one
+            self.resolve_commit_trans()
+        if not cloning and self.is_up_to_date(depot):
+            # nothing has happened in the depot since the last import
+            while self.check('import'):
+                self.next()
+            toGit('feature done')
+            toGit('done')
+            sys.stdout.flush()
+            log_to_file('end of import, already up to date')
+            return
+
         if not cloning:
             # this does not apply for clone, either in a new or reused wspace
             self.remove_all_members('fetch')
@@ -1645,16 +3701,45 @@ class RemoteParser(object):
                 log_to_file('[import ref]: %s (%s)' % (ref, ref_head))
             self.next()
 
+        if not cloning:
+            # before fast-import reads the marks
+            self.compact_marks()
         toGit('feature done')
         if os.path.exists(self._git_marks):
             toGit('feature import-marks=%s' % self._git_marks.strip('"'))
         toGit('feature export-marks=%s' % self._git_marks.strip('"'))
         sys.stdout.flush()
 
-        update_parser = UpdateParser(self._ws_top, self._reroot, self._server, auth_opt=self._auth_opt, show_progress=self._show_progress)
-        if self._path and cloning:
+        # 'accurev.import.transbatch' imports one commit per that many transactions
+        trans_batch = get_git_config_int('accurev.import.transbatch', 0, repo=self._repo)
+        if not cloning and trans_batch > 0 and ref_head and \
+                not get_git_config("accurev.trans.targettrans", repo=self._repo):
+            last_trans = self.get_imported_trans(depot, ref_head)
+            if last_trans:
+                self.do_incremental_import(depot, ref_head, last_trans, trans_batch)
+                toGit('done')
+                sys.stdout.flush()
+                log_to_file('end of import')
+                return
+
+        update_parser = self.new_update_parser(ref_head)
+        # 'accurev.clone.jobs' populates a clone in that many concurrent batches
+        clone_jobs = max(1, get_git_config_int('accurev.clone.jobs', 1, repo=self._repo))
+        # 'accurev.clone.maxscratch' caps the disk space used by populated files that are not yet in git
+        max_scratch = get_git_config_size('accurev.clone.maxscratch', 0, repo=self._repo)
+        if resume_clone:
+            self.resume_clone(update_parser, clone_journal, clone_jobs)
+        elif self._path and cloning:
             # this covers the new and the reused wspace
             update_parser.do_incl(self._path)
+        elif cloning and (clone_jobs > 1 or max_scratch):
+            if not reuse_ws:
+                # bring the new wspace up to date without populating it
+                run_ac('update -9 -L {}'.format(self._ws_top), self._server, self._auth_opt)
+            batches = list(enumerate(self.get_clone_batches(clone_jobs, max_scratch)))
+            clone_journal.set_batches(batches)
+            self.watch_clone(update_parser, clone_journal)
+            update_parser.do_parallel_pop(self._path, batches, clone_jobs, drain=True)
         elif cloning and reuse_ws:
             update_parser.do_pop(self._path)
         else:
@@ -1665,69 +3750,52 @@ class RemoteParser(object):
                 # set_git_config("accurev.trans.targettrans", '', repo=self._repo)
             else:
                 update_parser.do_update(root)
+        update_parser.close()
 
-        if not self._target_trans:
+        if self._target_trans:
+            update_trans = self._target_trans
+        else:
             # 'info' command in 7.0 and above contains the transaction information
             # use 'show wspaces' command to get the update trans to maintain
             # compatibility with older versions
             ws_name = get_git_config('accurev.{}.wsname'.format(self._alias), repo=self._repo)
-            trans_parser = UpdateTransParser(self._server, self._auth_opt)
+            trans_parser = UpdateTransParser(self._server, self._auth_opt, ws_name)
             update_trans = trans_parser.get_update_trans(ws_name)
 
-        # to differentiate changes from the real user in 'git blame'
-        principal = 'others'
-        
         commit_mark = 1
+        committed = False
         #logging.debug('update_parser:\n{}'.format(update_parser))
         if cloning or update_parser._elem_list:
+            committed = True
             #self.write_commit(info, ref_head)
-            commit_mark = update_parser._mark
-            toGit('reset %s/heads/master' % self._prefix)
-            toGit('commit %s/heads/master' % self._prefix)
-            toGit('mark :{}'.format(commit_mark))
-
+            trans_hist = None
             if self._target_trans:
-                trans = TransHistParser(self._target_trans, self.get_depot(), self._server, self._auth_opt)
-                tz_offset = get_tz_offset()
-                commit_time = int(trans.time)
-                # ('author' (SP <name>)? SP LT <email> GT SP <when> LF)?
-                # 'committer' (SP <name>)? SP LT <email> GT SP <when> LF
-                toGit('author {} <{}> {} {}'.format(trans.user, '@accurev.com', commit_time, tz_offset))
-                toGit('committer {} <{}> {} {}'.format(trans.user, '@accurev.com', commit_time, tz_offset))
-
-                comments = 'import from accurev @ {}:{}\n[{}: {}]'.format(depot, self._target_trans, trans.type, trans.comment)
-            else:
-                tz_offset = get_tz_offset()
-                commit_time = int(time.time())
-                # ('author' (SP <name>)? SP LT <email> GT SP <when> LF)?
-                # 'committer' (SP <name>)? SP LT <email> GT SP <when> LF
-                toGit('author {} <{}> {} {}'.format(principal, '@.com', commit_time, tz_offset))
-                toGit('committer {} <{}> {} {}'.format(principal, '@.com', commit_time, tz_offset))
-
-                comments = 'import from accurev @ {}:{}'.format(depot, update_trans)
+                trans_hist = TransHistParser(self._target_trans, depot, self._server, self._auth_opt)
+            commit_mark = self.write_import_commit(update_parser, depot, update_trans, ref_head, trans_hist)
+        update_parser._elem_list.close()
 
-            toGit('data {}'.format(len(comments)))
-            toGit(comments)
-            if ref_head:
-                toGit('from {}'.format(ref_head))
-
-            for elem in update_parser._elem_list:
-                #logging.debug(elem)
-                toGit(elem)
-
-        if update_parser._has_incoming_changes:
+        if update_parser._has_incoming_changes and committed:
             toGit('')
             toGit('reset {}/heads/master'.format(self._prefix))
             toGit('from :{}'.format(commit_mark))
             toGit('')
+        if update_trans and ref_head and not committed:
+            # an empty update, the tip stays what git already has
+            self.set_imported_trans(ref_head, update_trans)
 
         toGit('done')
         sys.stdout.flush()
 
         if cloning:
+            # the clone is in git, there is nothing left to resume
+            clone_journal.close()
+            clone_journal.remove()
             # make the newly created workspace hidden to avoid user's meddling
             # can only remove the wspace after we have done an update
             run_ac('rmws "{}"'.format(ws_name), self._server, self._auth_opt)
+            if self._wspace_entry:
+                self._wspace_entry['hidden'] = 'true'
+                self._wspace_catalog.update(ws_name, self._wspace_entry)
 
         log_to_file('end of import')
     
@@ -1762,8 +3830,12 @@ class RemoteParser(object):
                 self._show_progress = ('true' in line)
                 toGit('ok')
             elif self.check('option push-option'):
-                self._push_option = line.replace('option push-option ', '').strip('"').lower()
-                log_to_file('[Push Option]: {}'.format(self._push_option))
+                push_option = line.replace('option push-option ', '').strip('"').lower()
+                log_to_file('[Push Option]: {}'.format(push_option))
+                if push_option == 'squash':
+                    self._squash = True
+                else:
+                    self._push_option = push_option
                 toGit('ok')
             elif self.check('option'):
                 toGit('unsupported')
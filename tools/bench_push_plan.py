@@ -0,0 +1,56 @@
+#!/usr/bin/python2
+# Compares how a push used to move paths between its defunct, add and keep
+# lists (list.remove per path) with PushPlan, for commits where half of the
+# files turn out to be external and have to be added instead of kept.
+#
+#   python tools/bench_push_plan.py [files ...]
+#
+# Runs next to pythonCLI.py with its dependencies installed.
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pythonCLI import PushPlan
+
+
+def bench(n):
+    paths = ['dir{}/file{}.c'.format(i // 100, i) for i in range(n)]
+    external = paths[:]
+    random.seed(1)
+    random.shuffle(external)
+    external = external[:n // 2]
+
+    start = time.time()
+    keep_list = list(paths)
+    add_list = []
+    for path in external:
+        keep_list.remove(path)
+        add_list.append(path)
+    old = time.time() - start
+
+    start = time.time()
+    plan = PushPlan()
+    for path in paths:
+        plan.set(path, 'keep')
+    for path in external:
+        plan.set(path, 'add')
+    plan.paths('keep')
+    plan.paths('add')
+    new = time.time() - start
+    return old, new
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 25000, 50000, 100000]
+    for n in sizes:
+        old, new = bench(n)
+        print('{:>7} files: list.remove {:8.2f}s  PushPlan {:6.3f}s'.format(n, old, new))
+
+
+if __name__ == '__main__':
+    main()